@@ -2,377 +2,2936 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
+import argparse
+import bisect
 import json
 import hashlib
 import base64
-import shutil
+import struct
+import threading
+import time
+import queue
+import random
+import resource
+import multiprocessing
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
+from urllib.parse import urlsplit
 
 import cloudscraper
-from bs4 import BeautifulSoup
+# OpenCV 在导入时读取解码像素上限（即 DECODE_PIXEL_BUDGET），必须先于 import cv2 设置
+if not os.environ.get("OPENCV_IO_MAX_IMAGE_PIXELS"):
+    os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"] = "50000000"
 import cv2
+from lxml import etree
+import numpy as np
 import requests
 
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
 # ==== 配置 ====
 BRIGHTNESS_THRESHOLD = 130
 BATCH_SIZE = 100
-TEMP_DIR = "temp_download"
-LOCAL_DIR = "local_images"
+# WebP 编码：先用 WEBP_QUALITY，结果超过 WEBP_TARGET_BYTES 时在 [WEBP_MIN_QUALITY, WEBP_QUALITY)
+# 内二分查找满足大小的最高质量（最多再编码 WEBP_SEARCH_STEPS 次）；源文件本身是更小的 WebP 时原样使用
+WEBP_QUALITY = 85
+WEBP_MIN_QUALITY = 60
+WEBP_TARGET_BYTES = 500 * 1024
+WEBP_SEARCH_STEPS = 4
+# 解码前先从文件头读取尺寸：超过 DECODE_PIXEL_BUDGET 像素的 JPEG 在解码阶段按 1/2、1/4、1/8 缩小
+# （内存随之按比例下降），其他格式只能完整解码，超出预算即拒绝；文件头读不到尺寸的格式（BMP、TIFF、
+# AVIF 等）由 OpenCV 的 OPENCV_IO_MAX_IMAGE_PIXELS 在分配内存前拒绝。保存的图片长边不超过 MAX_OUTPUT_SIDE
+DECODE_PIXEL_BUDGET = int(os.environ["OPENCV_IO_MAX_IMAGE_PIXELS"])
+MAX_OUTPUT_SIDE = 8192
+# 额外输出同编号的 AVIF（OpenCV 支持且比 WebP 小时才保留）
+ENCODE_AVIF = os.environ.get("SCRAPER_AVIF") == "1"
+AVIF_QUALITY = 60
+# 缩略图：后缀 → 长边像素，与原图同编号（N.s.webp / N.m.webp），原图不大于该尺寸时不生成
+THUMBNAIL_SIZES = {".s.webp": 240, ".m.webp": 720}
+THUMBNAIL_QUALITY = 75
+# 文件夹索引中用单个字母标记已有的附加文件
+VARIANT_CODES = {".s.webp": "s", ".m.webp": "m", ".avif": "a"}
+# 各文件夹的索引按编号分块保存为 <文件夹>/index/<k>.json（第 k 块为编号 k*INDEX_CHUNK+1 起的 INDEX_CHUNK 项），
+# 每批只重写改动过的块，提交大小与文件夹总量无关
+INDEX_CHUNK = 1000
+# 同时在途的页面数（在当前游标之前预取后续ID）
+PAGE_CONCURRENCY = 4
+# 图片并发下载数（所有页面共享）及单个主机的初始并发数
+IMAGE_CONCURRENCY = 8
+PER_HOST_CONCURRENCY = 4
+# 每个主机的令牌桶速率（请求/秒）与并发数按 AIMD 调整：成功时加性增长，
+# 遇到 429/503、Cloudflare 质询、超时或延迟突增（超过平均值 HOST_LATENCY_SPIKE 倍）时减半
+HOST_INITIAL_RATE = 4.0
+HOST_MIN_RATE = 0.5
+HOST_MAX_RATE = 40.0
+HOST_MAX_CONCURRENCY = IMAGE_CONCURRENCY
+HOST_LATENCY_SPIKE = 3.0
+# 分类和 WebP 编码的进程数
+CPU_WORKERS = os.cpu_count() or 2
+# 本地状态目录（崩溃恢复日志和待提交的 WebP），在 Actions 中通过缓存跨运行保留
+STATE_DIR = os.environ.get("SCRAPER_STATE_DIR", ".scraper_state")
+SPOOL_DIR = os.path.join(STATE_DIR, "spool")
+JOURNAL_PATH = os.path.join(STATE_DIR, "journal.jsonl")
+# 每写入多少条日志记录落盘一次（fsync）；提交记录总是立即落盘
+JOURNAL_SYNC_EVERY = 20
+# 页面缓存（ETag/Last-Modified、图片链接、状态），按 LRU 保留的最大条数
+PAGE_CACHE_PATH = os.path.join(STATE_DIR, "page_cache.json")
+PAGE_CACHE_MAX = 5000
+# Cloudflare 会话（cookies + User-Agent）加密保存在状态目录，密钥取 SCRAPER_SESSION_KEY，未设置时由 GH_TOKEN 派生
+SESSION_CACHE_PATH = os.path.join(STATE_DIR, "session.bin")
+SESSION_KEY = os.environ.get("SCRAPER_SESSION_KEY", "")
+# 运行指标：各阶段耗时直方图、字节数、重试次数、队列深度和进程内存，结束时打印汇总表并写入 METRICS_PATH；
+# 设置 SCRAPER_PROM_TEXTFILE 时另写一份 Prometheus 文本格式（node_exporter textfile collector）
+METRICS_ENABLED = os.environ.get("SCRAPER_METRICS", "1") != "0"
+METRICS_PATH = os.path.join(STATE_DIR, "metrics.json")
+PROMETHEUS_TEXTFILE = os.environ.get("SCRAPER_PROM_TEXTFILE", "")
+# 耗时直方图的桶上界（秒）
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
 
+# 图片站点
+SITE_URL = "https://img.hyun.cc"
 # 起始ID
 START_ID = 342
-# 最大连续404次数（真正的结束）
+# 最大连续404次数（真正的结束；仅在无法预先发现末尾ID时使用）
 MAX_404_COUNT = 5
+# 页面/图片请求遇到超时、连接错误、5xx、429 或质询时按指数退避重试（等待时间随机取上限的 50%~100%），
+# 单个请求最多重试 RETRY_ATTEMPTS 次，整次运行最多重试 RETRY_BUDGET 次
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+RETRY_BUDGET = 200
+# 重试用尽的页面ID/图片URL记入 progress.json 的死信列表，进度照常推进，下次运行先重试死信；
+# 连续 DEAD_LETTER_MAX_RUNS 次运行都失败的条目放弃。连续 MAX_CONSECUTIVE_ERRORS 个页面出错
+# 或重试预算用完时视为站点故障，停止运行且不越过出错的页面
+DEAD_LETTER_MAX_RUNS = 5
+MAX_CONSECUTIVE_ERRORS = 5
+# 先从 RSS/首页列表发现最新ID，失败时用指数+二分探测；关闭则回退到连续404规则
+DISCOVER_RANGE = True
+DISCOVERY_PATHS = ["/index.php/feed/", "/"]
 
 # 目标私有仓库
 TARGET_REPO = os.environ.get("TARGET_REPO", "")
 GITHUB_TOKEN = os.environ.get("GH_TOKEN", "")
 TARGET_BRANCH = "main"
+GITHUB_API = os.environ.get("GITHUB_API_URL", "https://api.github.com")
+# 速率限制/服务端错误的最大重试次数及单次最长等待秒数
+GITHUB_MAX_RETRIES = 4
+# Contents API 目录列表的条目上限（超过的部分不返回）
+CONTENTS_LIST_MAX = 1000
+GITHUB_MAX_WAIT = 900
+# 并行创建 blob 的线程数；单个提交包含的最大文件数（超过则链式分块提交，最后统一移动分支）
+UPLOAD_CONCURRENCY = 8
+COMMIT_CHUNK_SIZE = 500
+# 边爬边传：每批最多文件数/字节数（在页面边界提交）；已排队未提交的字节上限，超过时爬取等待
+UPLOAD_BATCH_FILES = 200
+UPLOAD_BATCH_BYTES = 50 * 1024 * 1024
+UPLOAD_BUFFER_BYTES = 200 * 1024 * 1024
 
 # 目标仓库中的路径
 IMAGES_DIR = "ri"
 FOLDERS = ["vd", "vl", "hd", "hl"]
+# 分片哈希注册表目录；增量分片超过该条数时合并进基础分片
+REGISTRY_DIR = f"{IMAGES_DIR}/registry"
+REGISTRY_DELTA_MAX = 256
+# 来源 URL/ETag 索引目录，已知图片在下载前跳过
+URL_INDEX_DIR = f"{REGISTRY_DIR}/urls"
+# 感知哈希（dHash）目录；汉明距离不超过阈值视为近似重复，设为 -1 关闭
+PHASH_DIR = f"{REGISTRY_DIR}/phash"
+# 分类特征（宽、高、平均亮度），调整阈值后可直接重新分桶
+FEATURE_DIR = f"{REGISTRY_DIR}/features"
+# 分片模式的暂存目录：<name>/<hash>.webp 为分片产出的图片，<name>.json 为分片清单
+STAGING_DIR = f"{IMAGES_DIR}/staging"
+PHASH_THRESHOLD = 6
 
 scraper = cloudscraper.create_scraper(
     browser={'browser': 'chrome', 'platform': 'windows', 'mobile': False}
 )
+# 扩大连接池，使并发下载复用 keep-alive 连接（保留 cloudscraper 的 TLS 适配器）
+for _adapter in scraper.adapters.values():
+    _adapter.init_poolmanager(IMAGE_CONCURRENCY, IMAGE_CONCURRENCY + PAGE_CONCURRENCY)
+
+download_pool = ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY)
+_host_limiters = {}
+_host_limiters_lock = threading.Lock()
+
+
+# ============ 运行指标 ============
+
+class Metrics:
+    """
+    进程内的轻量指标：阶段耗时直方图（固定桶）、计数器和瞬时值采样（队列深度、进程内存）
+    计数器和采样名为 "分组.名称"，导出 Prometheus 时分组成为指标名、名称成为标签
+    热路径上只有一次 bisect 和一次加锁累加；关闭时记录方法直接返回
+    """
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        slot = bisect.bisect_left(METRIC_BUCKETS, seconds)
+        with self._lock:
+            hist = self.histograms.get(stage)
+            if hist is None:
+                hist = self.histograms[stage] = {"buckets": [0] * (len(METRIC_BUCKETS) + 1),
+                                                 "count": 0, "sum": 0.0, "max": 0.0}
+            hist["buckets"][slot] += 1
+            hist["count"] += 1
+            hist["sum"] += seconds
+            hist["max"] = max(hist["max"], seconds)
+    
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+    
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+    
+    def gauge(self, name: str, value: float):
+        """瞬时值：保留最近值、最大值和平均值"""
+        if not self.enabled:
+            return
+        with self._lock:
+            g = self.gauges.get(name)
+            if g is None:
+                g = self.gauges[name] = {"last": 0, "max": value, "sum": 0.0, "samples": 0}
+            g["last"] = value
+            g["max"] = max(g["max"], value)
+            g["sum"] += value
+            g["samples"] += 1
+    
+    def quantile(self, stage: str, q: float) -> float:
+        """按桶估算分位数（取所在桶的上界，不超过观测到的最大值）"""
+        hist = self.histograms[stage]
+        rank = q * hist["count"]
+        seen = 0
+        for bound, n in zip(METRIC_BUCKETS + (hist["max"],), hist["buckets"]):
+            seen += n
+            if seen >= rank:
+                return min(bound, hist["max"])
+        return hist["max"]
+    
+    def snapshot(self, command: str) -> dict:
+        with self._lock:
+            return {
+                "command": command,
+                "started": self.started,
+                "duration": time.time() - self.started,
+                "buckets": list(METRIC_BUCKETS),
+                "stages": {stage: {**hist, "buckets": list(hist["buckets"]),
+                                   "p50": self.quantile(stage, 0.5), "p95": self.quantile(stage, 0.95)}
+                           for stage, hist in self.histograms.items()},
+                "counters": dict(self.counters),
+                "gauges": {name: {"last": g["last"], "max": g["max"],
+                                  "mean": g["sum"] / g["samples"]}
+                           for name, g in self.gauges.items()}
+            }
+    
+    def print_summary(self):
+        if not self.enabled or not self.histograms:
+            return
+        print(f"\n⏱️ 阶段耗时:")
+        # 表头中文字符占两列
+        print(f"   {'阶段':<18}{'次数':>5}{'总计s':>7}{'平均ms':>7}{'p50ms':>9}{'p95ms':>9}{'最大ms':>7}")
+        for stage in sorted(self.histograms):
+            hist = self.histograms[stage]
+            print(f"   {stage:<20}{hist['count']:>7}{hist['sum']:>9.1f}"
+                  f"{hist['sum'] / hist['count'] * 1000:>9.1f}{self.quantile(stage, 0.5) * 1000:>9.1f}"
+                  f"{self.quantile(stage, 0.95) * 1000:>9.1f}{hist['max'] * 1000:>9.1f}")
+        if self.counters:
+            print(f"🔢 " + ", ".join(
+                f"{name} {value / 1048576:.1f}MB" if name.startswith("bytes.") else f"{name} {value:g}"
+                for name, value in sorted(self.counters.items())))
+        if self.gauges:
+            print(f"📏 采样: " + ", ".join(
+                f"{name} 平均 {g['sum'] / g['samples']:.1f}/最大 {g['max']:g}"
+                for name, g in sorted(self.gauges.items())))
+    
+    def prometheus(self, command: str) -> str:
+        snap = self.snapshot(command)
+        lines = []
+        
+        def family(name: str, kind: str, help_text: str):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        
+        family("scraper_stage_seconds", "histogram", "Per-stage latency")
+        for stage, hist in sorted(snap["stages"].items()):
+            labels = f'command="{command}",stage="{stage}"'
+            total = 0
+            for bound, n in zip(METRIC_BUCKETS, hist["buckets"]):
+                total += n
+                lines.append(f'scraper_stage_seconds_bucket{{{labels},le="{bound}"}} {total}')
+            lines.append(f'scraper_stage_seconds_bucket{{{labels},le="+Inf"}} {hist["count"]}')
+            lines.append(f"scraper_stage_seconds_sum{{{labels}}} {hist['sum']}")
+            lines.append(f"scraper_stage_seconds_count{{{labels}}} {hist['count']}")
+        
+        groups = {}
+        for name, value in snap["counters"].items():
+            group, _, kind = name.partition(".")
+            groups.setdefault(f"scraper_{group}_total", []).append((kind, value))
+        for metric, values in sorted(groups.items()):
+            family(metric, "counter", metric[len("scraper_"):-len("_total")])
+            for kind, value in sorted(values):
+                lines.append(f'{metric}{{command="{command}",kind="{kind}"}} {value}')
+        
+        groups = {}
+        for name, g in snap["gauges"].items():
+            group, _, kind = name.partition(".")
+            groups.setdefault(group, []).append((kind, g))
+        for group, values in sorted(groups.items()):
+            for stat in ["max", "mean"]:
+                family(f"scraper_{group}_{stat}", "gauge", f"{group} {stat} over the run")
+                for kind, g in sorted(values):
+                    lines.append(f'scraper_{group}_{stat}{{command="{command}",kind="{kind}"}} {g[stat]}')
+        
+        family("scraper_run_duration_seconds", "gauge", "Wall time of the last run")
+        lines.append(f'scraper_run_duration_seconds{{command="{command}"}} {snap["duration"]}')
+        family("scraper_last_run_timestamp_seconds", "gauge", "Start time of the last run")
+        lines.append(f'scraper_last_run_timestamp_seconds{{command="{command}"}} {snap["started"]}')
+        return "\n".join(lines) + "\n"
+    
+    def save(self, command: str):
+        """写入 METRICS_PATH 和可选的 Prometheus 文本文件（先写临时文件再替换，避免被读到一半）"""
+        if not self.enabled:
+            return
+        outputs = [(METRICS_PATH, json.dumps(self.snapshot(command), ensure_ascii=False, indent=2))]
+        if PROMETHEUS_TEXTFILE:
+            outputs.append((PROMETHEUS_TEXTFILE, self.prometheus(command)))
+        for path, text in outputs:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    f.write(text)
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"⚠️ 指标写入失败 {path}: {e}")
+        print(f"📈 指标已写入 {METRICS_PATH}" + (f" 和 {PROMETHEUS_TEXTFILE}" if PROMETHEUS_TEXTFILE else ""))
+
+
+metrics = Metrics(METRICS_ENABLED)
 
 
 # ============ GitHub API ============
 
-def github_get_sha(path: str) -> str | None:
-    if not GITHUB_TOKEN or not TARGET_REPO:
+class GitHubError(Exception):
+    def __init__(self, message: str, status: int = 0):
+        super().__init__(message)
+        self.status = status
+
+
+class GitHubClient:
+    """
+    所有 GitHub 请求共用的客户端：
+    连接池复用、运行内 SHA/内容缓存、If-None-Match 条件请求、按速率限制头退避
+    失败时抛出 GitHubError，而不是静默返回 None
+    """
+    
+    def __init__(self, token: str, repo: str, branch: str):
+        self.repo = repo
+        self.branch = branch
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=UPLOAD_CONCURRENCY)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"token {token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
+        # path -> {"etag", "sha", "content"}，content 为 None 表示远程不存在
+        self._cache = {}
+        self._lock = threading.Lock()
+    
+    def _retry_delay(self, resp: requests.Response, attempt: int) -> float | None:
+        """根据响应决定是否重试及等待秒数，None 表示不重试"""
+        if resp.status_code in [403, 429]:
+            if resp.headers.get("Retry-After"):
+                return float(resp.headers["Retry-After"])
+            if resp.headers.get("X-RateLimit-Remaining") == "0":
+                reset = int(resp.headers.get("X-RateLimit-Reset", "0"))
+                return max(reset - time.time(), 1)
+            if resp.status_code == 429 or "rate limit" in resp.text.lower():
+                return 60 * (attempt + 1)
+            return None
+        if resp.status_code >= 500:
+            return 2 ** attempt
         return None
     
-    url = f"https://api.github.com/repos/{TARGET_REPO}/contents/{path}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+    def request(self, method: str, url: str, ok: tuple = (200, 201), **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", 60)
+        for attempt in range(GITHUB_MAX_RETRIES + 1):
+            if attempt:
+                metrics.count("retries.github")
+            try:
+                with metrics.timer(f"github.{method.lower()}"):
+                    resp = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                if attempt == GITHUB_MAX_RETRIES:
+                    raise GitHubError(f"{method} {url}: {e}")
+                time.sleep(2 ** attempt)
+                continue
+            
+            if resp.status_code in ok:
+                return resp
+            
+            delay = self._retry_delay(resp, attempt)
+            if delay is None or delay > GITHUB_MAX_WAIT or attempt == GITHUB_MAX_RETRIES:
+                raise GitHubError(f"{method} {url}: {resp.status_code} {resp.text[:200]}",
+                                  resp.status_code)
+            print(f"⏳ GitHub {resp.status_code}，{delay:.0f}s 后重试 ({attempt + 1}/{GITHUB_MAX_RETRIES})")
+            time.sleep(delay)
     
-    try:
-        resp = requests.get(url, headers=headers, timeout=30)
-        if resp.status_code == 200:
-            return resp.json().get("sha")
-    except:
-        pass
-    return None
+    def contents_url(self, path: str) -> str:
+        return f"{GITHUB_API}/repos/{self.repo}/contents/{path}"
+    
+    def get_file(self, path: str) -> tuple:
+        """返回 (content, sha)，文件不存在时为 (None, None)；已缓存时用 If-None-Match 重新验证"""
+        with self._lock:
+            cached = self._cache.get(path)
+        
+        headers = {}
+        if cached and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        
+        resp = self.request("GET", self.contents_url(path), ok=(200, 304, 404),
+                            headers=headers, params={"ref": self.branch}, timeout=30)
+        if resp.status_code == 304:
+            return cached["content"], cached["sha"]
+        
+        if resp.status_code == 404:
+            entry = {"etag": None, "sha": None, "content": None}
+        else:
+            data = resp.json()
+            # 超过 1MB 的文件 Contents API 不返回内容，改用 blob 接口
+            if data.get("encoding") == "none":
+                content = self.get_blob(data["sha"])
+            else:
+                content = base64.b64decode(data["content"])
+            entry = {"etag": resp.headers.get("ETag"), "sha": data["sha"], "content": content}
+        
+        with self._lock:
+            self._cache[path] = entry
+        return entry["content"], entry["sha"]
+    
+    def get_blob(self, sha: str) -> bytes:
+        return base64.b64decode(self.git("GET", f"blobs/{sha}")["content"])
+    
+    def list_dir(self, path: str) -> list:
+        """
+        返回目录下的文件列表 [{"name", "sha", "size"}]，目录不存在时为空
+        Contents API 每个目录最多返回 CONTENTS_LIST_MAX 项，只用于条目数固定有上限的索引目录，
+        达到上限时抛出 GitHubError；图片和暂存目录用 list_tree
+        """
+        resp = self.request("GET", self.contents_url(path), ok=(200, 404),
+                            params={"ref": self.branch}, timeout=30)
+        if resp.status_code == 404:
+            return []
+        entries = resp.json()
+        if len(entries) >= CONTENTS_LIST_MAX:
+            raise GitHubError(f"{path}: 目录列表达到 Contents API 上限 {CONTENTS_LIST_MAX}，可能被截断")
+        return [e for e in entries if e.get("type") == "file"]
+    
+    def head(self) -> str:
+        return self.git("GET", f"ref/heads/{self.branch}")["object"]["sha"]
+    
+    def _tree(self, sha: str) -> list:
+        data = self.git("GET", f"trees/{sha}")
+        if data.get("truncated"):
+            raise GitHubError(f"tree {sha}: 列表被截断")
+        return data["tree"]
+    
+    def list_tree(self, path: str, commit: str = None) -> dict:
+        """
+        用 Git Trees API 列出目录下的文件 {name: sha}（不受 Contents API 的条目数限制），
+        commit 为 None 时取分支当前 HEAD；目录不存在时为空，列表被截断时抛出 GitHubError
+        """
+        tree = self.git("GET", f"commits/{commit or self.head()}")["tree"]["sha"]
+        for part in path.split("/"):
+            entry = next((e for e in self._tree(tree) if e["path"] == part and e["type"] == "tree"), None)
+            if entry is None:
+                return {}
+            tree = entry["sha"]
+        return {e["path"]: e["sha"] for e in self._tree(tree) if e["type"] == "blob"}
+    
+    def changed_only_under(self, path: str, base: str, head: str) -> bool:
+        """两个提交之间的差异是否全部在 path 目录内（逐层比较 tree，其余条目的 sha 必须相同）"""
+        trees = [self.git("GET", f"commits/{sha}")["tree"]["sha"] for sha in (base, head)]
+        parts = path.split("/")
+        for depth, part in enumerate(parts):
+            old, new = ({e["path"]: e["sha"] for e in self._tree(tree)} for tree in trees)
+            trees = [old.pop(part, None), new.pop(part, None)]
+            if old != new:
+                return False
+            if trees[0] == trees[1]:
+                return True
+            # 上层目录整个新建或删除时无法区分内容，按有改动处理
+            if depth < len(parts) - 1 and None in trees:
+                return False
+        return True
+    
+    def remember(self, path: str, content: bytes, sha: str):
+        """记录本次运行写入的文件，后续读取/更新无需再请求"""
+        with self._lock:
+            self._cache[path] = {"etag": None, "sha": sha, "content": content}
+    
+    def git(self, method: str, endpoint: str, payload: dict = None, ok: tuple = (200, 201)) -> dict:
+        """调用 Git Data API，endpoint 相对于 /repos/{repo}/git/"""
+        url = f"{GITHUB_API}/repos/{self.repo}/git/{endpoint}"
+        return self.request(method, url, ok=ok, json=payload).json()
+
+
+github = GitHubClient(GITHUB_TOKEN, TARGET_REPO, TARGET_BRANCH)
 
 
 def github_get_json(path: str) -> tuple:
     if not GITHUB_TOKEN or not TARGET_REPO:
         return None, None
     
-    url = f"https://api.github.com/repos/{TARGET_REPO}/contents/{path}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+    content, sha = github.get_file(path)
+    if content is None:
+        return None, None
+    return content.decode("utf-8"), sha
+
+
+def get_remote_json(path: str, default=None) -> dict:
+    """远程文件不存在时返回默认值；请求失败会抛出 GitHubError"""
+    content, _ = github_get_json(path)
+    if content:
+        try:
+            return json.loads(content)
+        except:
+            pass
+    return default if default is not None else {}
+
+
+def github_create_blob(content: bytes) -> str:
+    metrics.count("bytes.github_out", len(content))
+    return github.git("POST", "blobs", {
+        "content": base64.b64encode(content).decode("utf-8"),
+        "encoding": "base64"
+    })["sha"]
+
+
+def github_commit_files(files: dict, message: str, retry_on_conflict: bool = False) -> bool:
+    """
+    把 {path: bytes | str | None} 作为一次原子更新写入分支（str 为仓库中已有 blob 的 sha，None 表示删除）：
+    并行创建 blob → 按 COMMIT_CHUNK_SIZE 分块链式创建 tree/commit → 最后只移动一次分支引用
+    任一步失败则分支保持不变
+    
+    分支被其他写入者推进时（422），files 里的元数据是基于旧快照生成的，原样重放会覆盖对方的更新，
+    所以默认直接失败，由调用方下次重新读取后再提交；只有所有文件都归调用方独占（如分片暂存）时
+    才传 retry_on_conflict=True，基于新的 HEAD 重试
+    例外：本批不涉及 STAGING_DIR、而期间的新提交只改动了 STAGING_DIR（回填分片的暂存提交）时，
+    快照仍然有效，同样基于新的 HEAD 重试
+    """
+    if not GITHUB_TOKEN or not TARGET_REPO:
+        return False
+    
+    paths = [p for p in files if isinstance(files[p], bytes)]
+    try:
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            blob_shas = list(pool.map(github_create_blob, (files[p] for p in paths)))
+    except GitHubError as e:
+        print(f"❌ blob 创建失败，放弃提交: {e}")
+        return False
+    
+    entries = [{"path": p, "mode": "100644", "type": "blob", "sha": sha}
+               for p, sha in zip(paths, blob_shas)]
+    entries += [{"path": p, "mode": "100644", "type": "blob", "sha": files[p]}
+                for p in files if not isinstance(files[p], bytes)]
+    chunks = [entries[i:i + COMMIT_CHUNK_SIZE] for i in range(0, len(entries), COMMIT_CHUNK_SIZE)]
+    
+    touches_staging = any(p.startswith(STAGING_DIR + "/") for p in files)
+    
+    # 重试时基于新的 HEAD 重建（blob 可复用）
+    for attempt in range(3):
+        try:
+            base = head = github.git("GET", f"ref/heads/{TARGET_BRANCH}")["object"]["sha"]
+            tree = github.git("GET", f"commits/{head}")["tree"]["sha"]
+            
+            for idx, chunk in enumerate(chunks, 1):
+                tree = github.git("POST", "trees", {"base_tree": tree, "tree": chunk})["sha"]
+                chunk_msg = message if len(chunks) == 1 else f"{message} ({idx}/{len(chunks)})"
+                head = github.git("POST", "commits", {
+                    "message": chunk_msg, "tree": tree, "parents": [head]
+                })["sha"]
+        except GitHubError as e:
+            print(f"❌ 提交失败: {e}")
+            return False
+        
+        try:
+            github.git("PATCH", f"refs/heads/{TARGET_BRANCH}", {"sha": head, "force": False})
+        except GitHubError as e:
+            # 只有移动引用时的 422 表示分支被推进（非快进）；创建 tree 时的 422 是请求本身有误
+            if e.status == 422 and attempt < 2 and (retry_on_conflict or (
+                    not touches_staging and staging_only_since(base))):
+                metrics.count("retries.commit")
+                print(f"⚠️ 分支已更新，重试提交 ({attempt + 1}/3)")
+                continue
+            if e.status == 422:
+                print(f"❌ 分支已被其他任务更新，本批元数据已过期，放弃提交: {e}")
+            else:
+                print(f"❌ 提交失败: {e}")
+            return False
+        
+        for path, sha in zip(paths, blob_shas):
+            github.remember(path, files[path], sha)
+        return True
+    
+    return False
+
+
+def staging_only_since(base: str) -> bool:
+    """base 之后分支上的新提交是否只改动了 STAGING_DIR，无法确认时按否处理"""
+    try:
+        return github.changed_only_under(STAGING_DIR, base, github.head())
+    except GitHubError as e:
+        print(f"⚠️ 比较分支改动失败: {e}")
+        return False
+
+
+# ============ 哈希注册表 ============
+
+def git_blob_sha(content: bytes) -> str:
+    """与 GitHub 一致的 blob SHA（git hash-object）"""
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+class ShardedIndex:
+    """
+    存放在目标仓库目录中的紧凑分片索引，定长记录（键在前）：
+      XX.bin        基础分片，按键排序，二分查找
+      XX.delta.bin  增量分片，只追加；超过 REGISTRY_DELTA_MAX 条时合并进基础分片
+    XX 为键的十六进制前 PREFIX_LEN 位，分片在首次查询时才下载，提交时只上传改动过的分片
+    """
+    
+    RECORD = struct.Struct("<32s")
+    KEY_SIZE = 32
+    PREFIX_LEN = 2
+    
+    def __init__(self, client: GitHubClient, root: str):
+        self.client = client
+        self.root = root
+        self._files = {}
+        self._shards = {}
+        width = self.PREFIX_LEN
+        self._locks = {f"{i:0{width}x}": threading.Lock() for i in range(16 ** width)}
+        self.size = 0
+    
+    def load(self):
+        listing = self.client.list_dir(self.root)
+        self._files = {e["name"]: e["sha"] for e in listing}
+        self.size = sum(e["size"] for e in listing) // self.RECORD.size
+    
+    def preload(self):
+        """并行下载全部分片"""
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            list(pool.map(self._shard, self._locks))
+    
+    def _shard(self, prefix: str) -> dict:
+        with self._locks[prefix]:
+            shard = self._shards.get(prefix)
+            if shard is None:
+                base_sha = self._files.get(f"{prefix}.bin")
+                delta_sha = self._files.get(f"{prefix}.delta.bin")
+                base = self.client.get_blob(base_sha) if base_sha else b""
+                delta = self.client.get_blob(delta_sha) if delta_sha else b""
+                shard = {
+                    "base": base,
+                    "delta": {r[0]: r[1:] for r in self.RECORD.iter_unpack(delta)},
+                    "dirty": False
+                }
+                self._shards[prefix] = shard
+            return shard
+    
+    def _search(self, base: bytes, key: bytes) -> tuple | None:
+        size = self.RECORD.size
+        lo, hi = 0, len(base) // size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            probe = base[mid * size:mid * size + self.KEY_SIZE]
+            if probe < key:
+                lo = mid + 1
+            elif probe > key:
+                hi = mid
+            else:
+                return self.RECORD.unpack_from(base, mid * size)[1:]
+        return None
+    
+    def items(self):
+        """遍历已加载分片中的全部记录 (key, value)，增量记录覆盖基础分片中的同一键"""
+        for shard in list(self._shards.values()):
+            delta = dict(shard["delta"])
+            for record in self.RECORD.iter_unpack(shard["base"]):
+                if record[0] not in delta:
+                    yield record[0], record[1:]
+            yield from delta.items()
+    
+    def lookup(self, key: bytes) -> tuple | None:
+        shard = self._shard(key.hex()[:self.PREFIX_LEN])
+        return shard["delta"].get(key) or self._search(shard["base"], key)
+    
+    def put(self, key: bytes, value: tuple):
+        prefix = key.hex()[:self.PREFIX_LEN]
+        shard = self._shard(prefix)
+        with self._locks[prefix]:
+            if key not in shard["delta"] and self._search(shard["base"], key) is None:
+                self.size += 1
+            shard["delta"][key] = value
+            shard["dirty"] = True
+    
+    def _compact(self, prefix: str) -> bool:
+        shard = self._shards[prefix]
+        return len(shard["delta"]) > REGISTRY_DELTA_MAX
+    
+    def changed_files(self) -> dict:
+        """
+        返回需要提交的分片 {path: bytes | None}（None 表示删除），并把改动视为已落地：
+        同时更新目录中的文件表，同一次运行中后续合并能正确删除本次运行写入的增量分片
+        """
+        files = {}
+        for prefix, shard in sorted(self._shards.items()):
+            if not shard["dirty"]:
+                continue
+            
+            delta_name = f"{prefix}.delta.bin"
+            
+            if self._compact(prefix):
+                # 合并：增量记录覆盖基础分片中的同一键，再按键重新排序
+                merged = {r[0]: r for r in self.RECORD.iter_unpack(shard["base"])}
+                merged.update((k, (k, *v)) for k, v in shard["delta"].items())
+                shard["base"] = b"".join(self.RECORD.pack(*merged[k]) for k in sorted(merged))
+                shard["delta"] = {}
+                if shard["base"]:
+                    files[f"{self.root}/{prefix}.bin"] = shard["base"]
+                    self._files[f"{prefix}.bin"] = git_blob_sha(shard["base"])
+                if delta_name in self._files:
+                    files[f"{self.root}/{delta_name}"] = None
+                    del self._files[delta_name]
+            else:
+                records = b"".join(self.RECORD.pack(k, *v) for k, v in shard["delta"].items())
+                files[f"{self.root}/{delta_name}"] = records
+                self._files[delta_name] = git_blob_sha(records)
+            shard["dirty"] = False
+        return files
+
+
+class HashRegistry(ShardedIndex):
+    """
+    SHA-256 → 图片路径 的注册表，存放在 REGISTRY_DIR，按摘要第一个字节分片
+    记录格式: 32 字节摘要 + 1 字节文件夹序号 + 4 字节编号
+    """
+    
+    RECORD = struct.Struct("<32sBI")
+    
+    def __init__(self, client: GitHubClient):
+        super().__init__(client, REGISTRY_DIR)
+        self._legacy = False
+    
+    def load(self):
+        """读取分片目录；仓库里只有旧版 hash_registry.json 时一次性迁移"""
+        super().load()
+        if self._files:
+            return
+        
+        legacy = get_remote_json(f"{IMAGES_DIR}/hash_registry.json", {})
+        if not legacy:
+            return
+        
+        print(f"🔄 迁移旧版 hash_registry.json ({len(legacy)} 条)")
+        self._legacy = True
+        for prefix in self._locks:
+            self._shards[prefix] = {"base": b"", "delta": {}, "dirty": True}
+        for file_hash, path in legacy.items():
+            self._shards[file_hash[:2]]["delta"][bytes.fromhex(file_hash)] = self._encode(path)
+        self.size = len(legacy)
+    
+    @staticmethod
+    def _encode(path: str) -> tuple:
+        folder, name = path.split("/")
+        return FOLDERS.index(folder), int(name.split(".")[0])
+    
+    def get(self, file_hash: str) -> str | None:
+        value = self.lookup(bytes.fromhex(file_hash))
+        if value is None:
+            return None
+        return f"{FOLDERS[value[0]]}/{value[1]}.webp"
+    
+    def __contains__(self, file_hash: str) -> bool:
+        return self.get(file_hash) is not None
+    
+    def __setitem__(self, file_hash: str, path: str):
+        self.put(bytes.fromhex(file_hash), self._encode(path))
+    
+    def _compact(self, prefix: str) -> bool:
+        return self._legacy or super()._compact(prefix)
+    
+    def changed_files(self) -> dict:
+        files = super().changed_files()
+        if self._legacy:
+            files[f"{IMAGES_DIR}/hash_registry.json"] = None
+            self._legacy = False
+        return files
+
+
+class UrlIndex(ShardedIndex):
+    """
+    图片来源 → SHA-256 的索引，存放在 URL_INDEX_DIR，启动时并行整体加载
+    键为 URL 或 (ETag, Content-Length) 的 SHA-256 前 16 字节，用于在下载前识别已知图片
+    """
+    
+    RECORD = struct.Struct("<16s32s")
+    KEY_SIZE = 16
+    PREFIX_LEN = 1
+    
+    def __init__(self, client: GitHubClient):
+        super().__init__(client, URL_INDEX_DIR)
+    
+    @staticmethod
+    def url_key(url: str) -> bytes:
+        return hashlib.sha256(f"url:{url}".encode("utf-8")).digest()[:16]
+    
+    @staticmethod
+    def validator_key(etag: str, length: str) -> bytes:
+        return hashlib.sha256(f"etag:{etag}:{length}".encode("utf-8")).digest()[:16]
+    
+    def get(self, key: bytes) -> str | None:
+        value = self.lookup(key)
+        return value[0].hex() if value else None
+    
+    def add(self, keys: list, file_hash: str):
+        digest = bytes.fromhex(file_hash)
+        for key in keys:
+            if self.lookup(key) is None:
+                self.put(key, (digest,))
+
+
+class PhashIndex(ShardedIndex):
+    """
+    SHA-256 → 64 位 dHash，存放在 PHASH_DIR，启动时整体加载并建立多索引哈希表
+    """
+    
+    RECORD = struct.Struct("<32sQ")
+    PREFIX_LEN = 1
+    
+    def __init__(self, client: GitHubClient):
+        super().__init__(client, PHASH_DIR)
+    
+    def add(self, file_hash: str, phash: int):
+        self.put(bytes.fromhex(file_hash), (phash,))
+
+
+class FeatureIndex(ShardedIndex):
+    """
+    SHA-256 → 分类特征，存放在 FEATURE_DIR
+    记录格式: 32 字节摘要 + 宽、高各 2 字节 + 4 字节平均亮度（float32）
+    """
+    
+    RECORD = struct.Struct("<32sHHf")
+    PREFIX_LEN = 1
+    
+    def __init__(self, client: GitHubClient):
+        super().__init__(client, FEATURE_DIR)
+    
+    def add(self, file_hash: str, info: dict):
+        self.put(bytes.fromhex(file_hash),
+                 (min(info["width"], 0xFFFF), min(info["height"], 0xFFFF), info["brightness"]))
+
+
+class MultiIndexHash:
+    """
+    感知哈希的多索引哈希表：64 位拆成 4 段 16 位，每段一个倒排表
+    汉明距离 ≤ r 时至少有一段差异 ≤ r // 4 位，只需枚举这些段变体取候选再精确比较
+    （随机分布的 dHash 在 BK 树里半径 6 的查询几乎要遍历整棵树）
+    """
+    
+    CHUNKS = 4
+    
+    def __init__(self):
+        self.tables = [{} for _ in range(self.CHUNKS)]
+        self.size = 0
+    
+    @staticmethod
+    def _chunks(phash: int) -> list:
+        return [(phash >> (16 * i)) & 0xFFFF for i in range(MultiIndexHash.CHUNKS)]
+    
+    @staticmethod
+    def _variants(chunk: int, bits: int) -> list:
+        variants = [chunk]
+        frontier = [(chunk, -1)]
+        for _ in range(bits):
+            frontier = [(v ^ (1 << b), b) for v, last in frontier for b in range(last + 1, 16)]
+            variants += [v for v, _ in frontier]
+        return variants
+    
+    def add(self, phash: int, value):
+        self.size += 1
+        for table, chunk in zip(self.tables, self._chunks(phash)):
+            table.setdefault(chunk, []).append((phash, value))
+    
+    def find(self, phash: int, radius: int) -> tuple | None:
+        """返回半径内最近的 (distance, value)，没有则为 None"""
+        best = None
+        sub_radius = radius // self.CHUNKS
+        for table, chunk in zip(self.tables, self._chunks(phash)):
+            for variant in self._variants(chunk, sub_radius):
+                for candidate, value in table.get(variant, ()):
+                    d = (phash ^ candidate).bit_count()
+                    if d <= radius and (best is None or d < best[0]):
+                        best = (d, value)
+        return best
+
+
+# ============ 崩溃恢复日志 ============
+
+class CrawlJournal:
+    """
+    追加写入的 JSON Lines 日志，记录每个已处理的页面/图片和每次成功的提交：
+      {"t": "start", "last_id"}                   本日志对应的远程起始进度
+      {"t": "image", "page", "hash", "keys", "info", "size"}  新图片（文件在 SPOOL_DIR/<hash>.webp，
+                                                               info["extras"] 中的附加格式同名不同后缀）
+      {"t": "alias", "page", "hash", "keys", "target"}        重复/近似重复，target 为已登记的哈希
+      {"t": "dead", "page", "url", "index"}       下载重试用尽的图片，已记入死信
+      {"t": "page", "id", "status"}               页面处理完毕（status 为 "dead" 表示整页记入死信）
+      {"t": "commit", "last_id"}                  该进度之前的内容已提交
+    每 JOURNAL_SYNC_EVERY 条记录 fsync 一次，进程被取消时最多丢失最后几条
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+        self._unsynced = 0
+        self._lock = threading.Lock()
+    
+    def load(self) -> list:
+        records = []
+        if not os.path.exists(self.path):
+            return records
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # 最后一行可能在写入时被中断
+                    break
+        return records
+    
+    def start(self, last_id: int, records: list):
+        """重写日志：起始进度 + 仍未提交的记录"""
+        ensure_dir(os.path.dirname(self.path))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in [{"t": "start", "last_id": last_id}] + records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+    
+    def append(self, record: dict, sync: bool = False):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._unsynced += 1
+            if sync or self._unsynced >= JOURNAL_SYNC_EVERY:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._unsynced = 0
+    
+    def close(self, finished: bool):
+        """全部提交完成时删除日志，否则保留供下次运行恢复"""
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+            if finished and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+# ============ 图库状态与上传 ============
+
+class DeadLetter:
+    """
+    重试用尽的页面和图片，保存在 progress.json 的 "dead_letter" 中，与越过它们的进度在同一次提交中写入：
+      {"pages": {"<id>": {"runs", "last_failed"}}, "images": {"<url>": {"page", "index", "runs", "last_failed"}}}
+    runs 为失败过的运行次数，达到 DEAD_LETTER_MAX_RUNS 后放弃该条目
+    """
+    
+    def __init__(self, data: dict):
+        self.pages = data.setdefault("pages", {})
+        self.images = data.setdefault("images", {})
+        self.dirty = False
+    
+    @property
+    def size(self) -> int:
+        return len(self.pages) + len(self.images)
+    
+    def _fail(self, entries: dict, key: str, **fields) -> bool:
+        """记录一次失败，返回该条目是否仍保留"""
+        entry = entries.setdefault(key, {**fields, "runs": 0})
+        entry["runs"] += 1
+        entry["last_failed"] = time.strftime("%Y-%m-%d %H:%M")
+        self.dirty = True
+        if entry["runs"] >= DEAD_LETTER_MAX_RUNS:
+            del entries[key]
+            print(f"🪦 {key} 已连续 {DEAD_LETTER_MAX_RUNS} 次运行失败，放弃")
+            return False
+        return True
+    
+    def add_page(self, page_id: int) -> bool:
+        metrics.count("errors.dead_page")
+        return self._fail(self.pages, str(page_id))
+    
+    def add_image(self, url: str, page_id: int, index: int) -> bool:
+        metrics.count("errors.dead_image")
+        return self._fail(self.images, url, page=page_id, index=index)
+    
+    def remove_page(self, page_id: int):
+        if self.pages.pop(str(page_id), None):
+            self.dirty = True
+    
+    def remove_image(self, url: str):
+        if self.images.pop(url, None):
+            self.dirty = True
+
+
+class FolderIndex:
+    """
+    一个文件夹的分块索引，块在首次访问时下载，提交时只上传改动过的块
+    truncate 缩短后多出的块在提交时删除，只删除远程确实存在的块（旧图库只有 count.json，没有索引块）
+    """
+    
+    def __init__(self, folder: str, count: int):
+        self.folder = folder
+        self.count = count
+        self._chunks = {}
+        self._dirty = set()
+        self._removed = set()
+        self._remote = set()
+    
+    def path(self, k: int) -> str:
+        return f"{IMAGES_DIR}/{self.folder}/index/{k}.json"
+    
+    def _chunk(self, k: int) -> list:
+        if k not in self._chunks:
+            content = None
+            if self.count and k <= (self.count - 1) // INDEX_CHUNK:
+                content, _ = github_get_json(self.path(k))
+            if content is not None:
+                self._remote.add(k)
+            try:
+                self._chunks[k] = json.loads(content).get("items", []) if content else []
+            except ValueError:
+                self._chunks[k] = []
+        return self._chunks[k]
+    
+    def get(self, num: int) -> list | None:
+        items = self._chunk((num - 1) // INDEX_CHUNK)
+        offset = (num - 1) % INDEX_CHUNK
+        return items[offset] if offset < len(items) else None
+    
+    def set(self, num: int, entry: list | None):
+        """第 num 项（从 1 开始），块内中间缺失的编号填 null"""
+        k = (num - 1) // INDEX_CHUNK
+        items = self._chunk(k)
+        offset = (num - 1) % INDEX_CHUNK
+        if len(items) <= offset:
+            items.extend([None] * (offset + 1 - len(items)))
+        if items[offset] != entry:
+            items[offset] = entry
+            self._dirty.add(k)
+            self._removed.discard(k)
+    
+    def truncate(self, count: int):
+        """只保留前 count 项"""
+        old_chunks = (self.count - 1) // INDEX_CHUNK + 1 if self.count else 0
+        new_chunks = (count - 1) // INDEX_CHUNK + 1 if count else 0
+        for k in range(new_chunks, old_chunks):
+            self._chunk(k)
+            self._chunks[k] = []
+            self._dirty.discard(k)
+            if k in self._remote:
+                self._removed.add(k)
+        if count and count < self.count:
+            k = (count - 1) // INDEX_CHUNK
+            items = self._chunk(k)
+            keep = count - k * INDEX_CHUNK
+            if len(items) > keep:
+                del items[keep:]
+                self._dirty.add(k)
+        self.count = count
+    
+    def changed_files(self) -> dict:
+        files = {self.path(k): folder_index_json(self._chunks[k], k * INDEX_CHUNK + 1)
+                 for k in sorted(self._dirty)}
+        files.update({self.path(k): None for k in sorted(self._removed)})
+        self._remote |= self._dirty
+        self._remote -= self._removed
+        self._dirty.clear()
+        self._removed.clear()
+        return files
+
+
+class Library:
+    """目标仓库中图库的远程状态：注册表、各索引、计数和进度"""
+    
+    def __init__(self, client: GitHubClient):
+        self.registry = HashRegistry(client)
+        self.urls = UrlIndex(client)
+        self.phashes = PhashIndex(client)
+        self.phash_lookup = MultiIndexHash()
+        self.features = FeatureIndex(client)
+        self.folder_counts = {}
+        self.folder_indexes = {}
+        self.progress = {}
+        self.dead_letter = DeadLetter({})
+    
+    def load(self):
+        """读取远程状态，失败时抛出 GitHubError"""
+        self.progress = get_remote_json("progress.json", {"last_id": START_ID - 1})
+        self.dead_letter = DeadLetter(self.progress.setdefault("dead_letter", {}))
+        self.registry.load()
+        self.urls.load()
+        self.urls.preload()
+        self.phashes.load()
+        self.phashes.preload()
+        self.features.load()
+        self.folder_counts = get_remote_json(f"{IMAGES_DIR}/count.json", {})
+        
+        for f in FOLDERS:
+            if f not in self.folder_counts:
+                self.folder_counts[f] = 0
+            self.folder_indexes[f] = FolderIndex(f, self.folder_counts[f])
+        for key, (phash,) in self.phashes.items():
+            self.phash_lookup.add(phash, key.hex())
+    
+    def set_index_entry(self, folder: str, num: int, entry: list | None):
+        index = self.folder_indexes[folder]
+        index.set(num, entry)
+        index.count = max(index.count, num)
+    
+    def metadata_files(self, last_id: int) -> dict:
+        """当前元数据的快照（只含改动过的索引分片），进度记为 last_id"""
+        self.progress["last_id"] = last_id
+        self.dead_letter.dirty = False
+        files = {}
+        files.update(self.registry.changed_files())
+        files.update(self.urls.changed_files())
+        files.update(self.phashes.changed_files())
+        files.update(self.features.changed_files())
+        for index in self.folder_indexes.values():
+            files.update(index.changed_files())
+        for path, data in [(f"{IMAGES_DIR}/count.json", self.folder_counts),
+                           ("progress.json", self.progress)]:
+            files[path] = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
+        return files
+
+
+def index_entry(info: dict, size: int, file_hash: str) -> list:
+    variants = "".join(VARIANT_CODES[suffix] for suffix in info.get("extras", []))
+    return [info["width"], info["height"], size, round(info["brightness"], 1), file_hash[:16], variants]
+
+
+def folder_index_json(items: list, start: int) -> bytes:
+    """
+    文件夹索引的一块，供客户端不下载原图就能挑选/预览：
+    items[i] 对应 N = start + i，未知的编号为 null；块数由 count.json 和 chunk 推算
+    """
+    data = {"fields": ["width", "height", "bytes", "brightness", "hash", "variants"],
+            "variants": {code: suffix for suffix, code in VARIANT_CODES.items()},
+            "chunk": INDEX_CHUNK,
+            "start": start,
+            "items": items}
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def count_images(upload_queue: list) -> int:
+    """上传队列中的图片数（不含缩略图等附加文件）"""
+    return sum(1 for item in upload_queue if not item["variant"])
+
+
+def batch_upload_to_github(upload_queue: list, meta_files: dict, last_id: int) -> bool:
+    """把一批图片和对应的元数据作为一次原子提交上传到GitHub（没有图片时只提交元数据）"""
+    files = {}
+    for item in upload_queue:
+        with open(item["local_path"], "rb") as f:
+            files[item["remote_path"]] = f.read()
+    files.update(meta_files)
+    images = count_images(upload_queue)
+    
+    start = time.perf_counter()
+    ok = github_commit_files(files, f"Add {images} images, progress to {last_id}")
+    elapsed = time.perf_counter() - start
+    metrics.observe("github.commit_batch", elapsed)
+    
+    if ok:
+        print(f"📤 已提交: {images} 张图片 + {len(meta_files)} 个元数据文件, "
+              f"进度 → {last_id}, 耗时 {elapsed:.1f}s")
+    else:
+        print(f"❌ 上传失败，远程仓库停留在上一批")
+    return ok
+
+
+class StreamingUploader:
+    """
+    后台提交线程：主线程在页面边界把批次交给它，按顺序逐批提交
+    已排队但未提交的字节数超过 UPLOAD_BUFFER_BYTES 时 submit 阻塞，对爬取形成背压
+    某一批失败后不再提交后续批次，远程进度只会停在已提交的ID上
+    """
+    
+    def __init__(self, start_id: int, journal: CrawlJournal):
+        self.journal = journal
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self.queued_bytes = 0
+        self.failed = False
+        self.submitted_id = start_id
+        self.committed_id = start_id
+        self.committed_images = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+    
+    def submit(self, batch: dict):
+        with self._cond:
+            if self.queued_bytes and self.queued_bytes + batch["bytes"] > UPLOAD_BUFFER_BYTES:
+                print(f"⏸️ 上传缓冲已满 ({self.queued_bytes / 1048576:.0f}MB)，等待提交...")
+            while (self.queued_bytes and not self.failed
+                   and self.queued_bytes + batch["bytes"] > UPLOAD_BUFFER_BYTES):
+                self._cond.wait()
+            self.queued_bytes += batch["bytes"]
+        self._queue.put(batch)
+    
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+            
+            ok = not self.failed and batch_upload_to_github(batch["items"], batch["files"],
+                                                            batch["last_id"])
+            # 失败的批次保留在本地，下次运行从恢复日志重放
+            if ok:
+                self.journal.append({"t": "commit", "last_id": batch["last_id"]}, sync=True)
+                for item in batch["items"]:
+                    if os.path.exists(item["local_path"]):
+                        os.remove(item["local_path"])
+            
+            with self._cond:
+                self.queued_bytes -= batch["bytes"]
+                if ok:
+                    self.committed_id = batch["last_id"]
+                    self.committed_images += count_images(batch["items"])
+                    self.batches += 1
+                else:
+                    self.failed = True
+                self._cond.notify_all()
+    
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def flush_uploads(uploader: StreamingUploader, library: Library, upload_queue: list, last_id: int):
+    """在页面边界交出当前批次：此时 last_id 及之前页面的图片都已在队列中"""
+    # 没有新图片、索引和死信也没有变化且进度未前进时不产生空提交
+    dead_letter_changed = library.dead_letter.dirty
+    files = library.metadata_files(last_id)
+    if not upload_queue and last_id == uploader.submitted_id and len(files) == 2 and not dead_letter_changed:
+        return
+    
+    uploader.submit({
+        "items": list(upload_queue),
+        "files": files,
+        "last_id": last_id,
+        "bytes": sum(item["size"] for item in upload_queue)
+    })
+    uploader.submitted_id = last_id
+    upload_queue.clear()
+
+
+# ============ 图片登记与恢复 ============
+
+def spool_path(file_hash: str, suffix: str = ".webp") -> str:
+    return os.path.join(SPOOL_DIR, f"{file_hash}{suffix}")
+
+
+def assign_image(library: Library, file_hash: str, keys: list, info: dict, size: int) -> tuple:
+    """给新图片编号并登记到各索引，返回 (文件夹, 编号)"""
+    target_folder = info["folder"]
+    library.folder_counts[target_folder] += 1
+    new_num = library.folder_counts[target_folder]
+    
+    library.registry[file_hash] = f"{target_folder}/{new_num}.webp"
+    library.urls.add(keys, file_hash)
+    library.phashes.add(file_hash, info["phash"])
+    library.phash_lookup.add(info["phash"], file_hash)
+    library.features.add(file_hash, info)
+    library.set_index_entry(target_folder, new_num, index_entry(info, size, file_hash))
+    return target_folder, new_num
+
+
+def register_image(library: Library, upload_queue: list, file_hash: str, keys: list,
+                   info: dict, size: int) -> str:
+    """给新图片编号、登记到各索引并加入上传队列，返回远程路径"""
+    target_folder, new_num = assign_image(library, file_hash, keys, info, size)
+    
+    remote_path = f"{IMAGES_DIR}/{target_folder}/{new_num}.webp"
+    upload_queue.append({
+        "local_path": spool_path(file_hash),
+        "remote_path": remote_path,
+        "hash": file_hash,
+        "size": size,
+        "variant": None
+    })
+    # 附加文件（缩略图、.avif）与主文件同编号
+    for suffix in info.get("extras", []):
+        upload_queue.append({
+            "local_path": spool_path(file_hash, suffix),
+            "remote_path": f"{IMAGES_DIR}/{target_folder}/{new_num}{suffix}",
+            "hash": file_hash,
+            "size": os.path.getsize(spool_path(file_hash, suffix)),
+            "variant": suffix
+        })
+    return remote_path
+
+
+def register_alias(library: Library, file_hash: str, keys: list, target: str):
+    """重复图片只记录来源；近似重复（target 不同）的哈希指向已有条目的路径"""
+    if target != file_hash:
+        library.registry[file_hash] = library.registry.get(target)
+    library.urls.add(keys, file_hash)
+
+
+def resume_from_journal(journal: CrawlJournal, library: Library, upload_queue: list) -> int | None:
+    """
+    重放上次运行中已处理但未提交的页面，返回已处理到的ID（None 表示没有可恢复的内容）
+    重放的图片重新编号后进入上传队列，随后的爬取从该ID之后继续
+    """
+    records = journal.load()
+    remote_last = library.progress.get("last_id", START_ID - 1)
+    
+    if not records or records[0].get("t") != "start" or records[0]["last_id"] > remote_last:
+        if records:
+            print("⚠️ 恢复日志与远程进度不一致，丢弃")
+        journal.start(remote_last, [])
+        return None
+    
+    # 按页面分组，只重放远程进度之后、完整处理过的页面
+    pages = {}
+    for record in records:
+        if record["t"] in ["image", "alias", "dead"] and record["page"] > remote_last:
+            pages.setdefault(record["page"], []).append(record)
+        elif record["t"] == "page" and record["id"] > remote_last:
+            pages.setdefault(record["id"], []).append(record)
+    
+    replayed = []
+    last_id = None
+    for page_id in sorted(pages):
+        page_records = pages[page_id]
+        if page_records[-1]["t"] != "page":
+            break
+        # WebP 缺失（例如缓存没有保存）则从该页开始重新爬取
+        if any(r["t"] == "image" and not all(os.path.exists(spool_path(r["hash"], suffix))
+                                             for suffix in [".webp"] + r["info"].get("extras", []))
+               for r in page_records):
+            break
+        
+        for r in page_records:
+            keys = [bytes.fromhex(k) for k in r.get("keys", [])]
+            if r["t"] == "image" and r["hash"] not in library.registry:
+                register_image(library, upload_queue, r["hash"], keys, r["info"], r["size"])
+            elif r["t"] == "alias":
+                register_alias(library, r["hash"], keys, r["target"])
+            elif r["t"] == "dead":
+                library.dead_letter.add_image(r["url"], r["page"], r["index"])
+            elif r["t"] == "page" and r["status"] == "dead":
+                library.dead_letter.add_page(r["id"])
+        replayed += page_records
+        last_id = page_id
+    
+    if last_id is not None:
+        print(f"♻️ 从恢复日志重放到 ID {last_id}，{count_images(upload_queue)} 张图片待上传")
+    journal.start(remote_last, replayed)
+    return last_id
+
+
+# ============ 工具函数 ============
+
+def build_url(page_id: int) -> str:
+    return f"{SITE_URL}/index.php/archives/{page_id}.html"
+
+
+def ensure_dir(path: str):
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+
+# ============ 图片处理 ============
+
+class PageCache:
+    """
+    存档页面的本地缓存，按ID记录 {"status", "etag", "last_modified", "images"}，404 另记 "below"：
+    请求时已知存在的最大ID。视频页面和已删除的ID（404 时已有更大的ID存在）直接短路，
+    末尾的404（当时可能只是尚未发布）和其余页面每次运行都用请求重新验证
+    按最近使用保留 PAGE_CACHE_MAX 条，随状态目录跨运行保存
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.entries = OrderedDict()
+        self.max_live = 0
+        self.stats = {"short_circuit": 0, "not_modified": 0, "fetched": 0}
+        self._lock = threading.Lock()
+    
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.entries = OrderedDict((int(k), v) for k, v in data["entries"])
+            self.max_live = data["max_live"]
+        except (ValueError, KeyError) as e:
+            print(f"⚠️ 页面缓存损坏，忽略: {e}")
+    
+    def save(self):
+        ensure_dir(os.path.dirname(self.path))
+        with self._lock:
+            data = {"max_live": self.max_live, "entries": list(self.entries.items())}
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+    
+    def get(self, page_id: int) -> dict | None:
+        with self._lock:
+            entry = self.entries.get(page_id)
+            if entry is not None:
+                self.entries.move_to_end(page_id)
+            return entry
+    
+    def put(self, page_id: int, entry: dict):
+        with self._lock:
+            if entry["status"] == "404":
+                entry["below"] = self.max_live
+            self.entries[page_id] = entry
+            self.entries.move_to_end(page_id)
+            while len(self.entries) > PAGE_CACHE_MAX:
+                self.entries.popitem(last=False)
+            if entry["status"] in ["ok", "video"]:
+                self.max_live = max(self.max_live, page_id)
+    
+    def mark_live(self, page_id: int):
+        with self._lock:
+            self.max_live = max(self.max_live, page_id)
+    
+    def count(self, key: str):
+        with self._lock:
+            self.stats[key] += 1
+
+
+# 直接在原始字节上用编译好的 XPath 取画廊链接，不构建 BeautifulSoup 树
+HTML_PARSER = etree.HTMLParser(encoding="utf-8")
+FANCYBOX_LINKS = etree.XPath("//a[@data-fancybox]")
+
+
+def extract_image_links(html: bytes) -> list:
+    """
+    提取 <a data-fancybox href=...> 图片链接
+    与 BeautifulSoup find_all("a", {"data-fancybox": True}) 结果一致：
+    index 按所有画廊链接计数，只保留 http 开头的链接
+    """
+    root = etree.fromstring(html, HTML_PARSER) if html.strip() else None
+    if root is None:
+        return []
+    images = []
+    for idx, link in enumerate(FANCYBOX_LINKS(root), 1):
+        href = link.get("href", "")
+        if href.startswith("http"):
+            images.append({"url": href, "index": idx})
+    return images
+
+
+def scrape_images(page_id: int, page_cache: PageCache) -> tuple:
+    """
+    爬取页面中的图片链接（经过页面缓存）
+    返回: (images_list, status)
+    status: "ok" | "video" | "404" | "error"
+    """
+    url = build_url(page_id)
+    cached = page_cache.get(page_id)
+    
+    if cached and cached["status"] == "video":
+        page_cache.count("short_circuit")
+        print(f"🎬 [{page_id}] 缓存: 视频页面，跳过")
+        return [], "video"
+    if cached and cached["status"] == "404" and page_id < cached.get("below", 0):
+        page_cache.count("short_circuit")
+        print(f"🗑️ [{page_id}] 缓存: 已删除")
+        return [], "404"
+    
+    headers = {}
+    if cached and cached["status"] == "ok":
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    
+    print(f"🌐 爬取: {url}")
+    
+    attempt = 0
+    while True:
+        try:
+            with metrics.timer("page.fetch"):
+                resp = polite_get(url, timeout=30, headers=headers)
+            if resp.status_code not in (304, 404):
+                resp.raise_for_status()
+            break
+        except Exception as e:
+            if not transient_error(e) or not retries.wait(attempt, "page"):
+                print(f"❌ 请求失败: {e}")
+                return [], "error"
+            attempt += 1
+            print(f"🔁 [{page_id}] 请求失败 ({e})，第 {attempt} 次重试")
+    
+    if resp.status_code == 304 and cached:
+        page_cache.count("not_modified")
+        print(f"♻️ [{page_id}] 未变化，使用缓存的 {len(cached['images'])} 个链接")
+        return [{"url": u, "index": i} for i, u in cached["images"]], "ok"
+    
+    page_cache.count("fetched")
+    
+    # 检查404
+    if resp.status_code == 404:
+        page_cache.put(page_id, {"status": "404"})
+        return [], "404"
+    
+    metrics.count("bytes.page_in", len(resp.content))
+    with metrics.timer("page.parse"):
+        images = extract_image_links(resp.content)
+    
+    page_cache.put(page_id, {
+        "status": "ok" if images else "video",
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "images": [[img["index"], img["url"]] for img in images]
+    })
+    
+    if not images:
+        # 没有图片，可能是视频页面
+        print(f"🎬 无图片（视频页面），跳过")
+        return [], "video"
+    
+    print(f"📷 找到 {len(images)} 张图片")
+    return images, "ok"
+
+
+class HostLimiter:
+    """
+    单个主机的限速器：令牌桶控制请求速率，动态上限控制同时在途的请求数
+    两者都按 AIMD 调整，收敛到对方能持续承受的最高速率；同一批并发失败只退避一次
+    """
+    
+    def __init__(self, host: str):
+        self.host = host
+        self.rate = HOST_INITIAL_RATE
+        self.limit = float(PER_HOST_CONCURRENCY)
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.latency = None
+        self.paused_until = 0.0
+        self.requests = 0
+        self.peak_rate = self.rate
+        self.events = []
+        self._refilled = time.monotonic()
+        self._last_backoff = 0.0
+        self._cond = threading.Condition()
+    
+    def _refill(self, now: float):
+        capacity = max(1.0, min(self.rate, self.limit))
+        self.tokens = min(capacity, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+    
+    def acquire(self) -> float:
+        waited = time.perf_counter()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.in_flight >= int(self.limit):
+                    wait = None
+                elif self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    break
+                self._cond.wait(wait)
+            self.tokens -= 1
+            self.in_flight += 1
+            self.requests += 1
+        metrics.observe("host.wait", time.perf_counter() - waited)
+        return time.monotonic()
+    
+    def release(self, started: float, outcome: str, reason: str = "", retry_after: float = 0):
+        """outcome: "ok" | "throttled" | "error"（其他错误不影响速率）"""
+        latency = time.monotonic() - started
+        with self._cond:
+            self.in_flight -= 1
+            if outcome == "throttled":
+                metrics.count("host.throttled")
+                self._backoff(reason, retry_after)
+            elif outcome == "ok":
+                if self.latency and latency > 1.0 and latency > HOST_LATENCY_SPIKE * self.latency:
+                    self._backoff(f"延迟 {latency:.1f}s")
+                else:
+                    self.limit = min(HOST_MAX_CONCURRENCY, self.limit + 1 / self.limit)
+                    self.rate = min(HOST_MAX_RATE, self.rate + 1 / self.rate)
+                    self.peak_rate = max(self.peak_rate, self.rate)
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self._cond.notify_all()
+    
+    def _backoff(self, reason: str, retry_after: float = 0):
+        now = time.monotonic()
+        if retry_after:
+            self.paused_until = max(self.paused_until, now + retry_after)
+        if now - self._last_backoff < max(1.0, self.latency or 0):
+            return
+        self._last_backoff = now
+        self.rate = max(HOST_MIN_RATE, self.rate / 2)
+        self.limit = max(1.0, self.limit / 2)
+        self.events.append({"reason": reason, "rate": self.rate, "limit": int(self.limit)})
+        print(f"🚦 {self.host} 退避 ({reason}): {self.rate:.1f} 请求/s, 并发 {int(self.limit)}"
+              + (f", 暂停 {retry_after:.0f}s" if retry_after else ""))
+    
+    @contextmanager
+    def request(self):
+        """占用一个请求名额直到 with 结束（流式下载包含正文），用 call.observe(resp) 报告结果"""
+        call = HostCall()
+        started = self.acquire()
+        try:
+            yield call
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                cloudscraper.exceptions.CloudflareException) as e:
+            call.outcome, call.reason = "throttled", type(e).__name__
+            raise
+        except Exception:
+            if call.outcome == "ok" and call.reason == "":
+                call.outcome = "error"
+            raise
+        finally:
+            self.release(started, call.outcome, call.reason, call.retry_after)
+
+
+class HostCall:
+    def __init__(self):
+        self.outcome = "ok"
+        self.reason = ""
+        self.retry_after = 0
+    
+    def observe(self, resp):
+        """429/503 和 Cloudflare 质询页视为限流，其余状态码不影响速率"""
+        if resp.status_code in (429, 503):
+            self.outcome, self.reason = "throttled", f"HTTP {resp.status_code}"
+            try:
+                self.retry_after = min(float(resp.headers.get("Retry-After", 0)), 300)
+            except ValueError:
+                pass
+        elif resp.status_code == 403 and (resp.headers.get("cf-mitigated") or
+                                          "challenge" in resp.headers.get("Server-Timing", "")):
+            self.outcome, self.reason = "throttled", "质询"
+        elif resp.status_code >= 400 and resp.status_code != 404:
+            self.outcome, self.reason = "error", f"HTTP {resp.status_code}"
+
+
+def host_limiter(url: str) -> HostLimiter:
+    host = urlsplit(url).netloc
+    with _host_limiters_lock:
+        if host not in _host_limiters:
+            _host_limiters[host] = HostLimiter(host)
+        return _host_limiters[host]
+
+
+def polite_get(url: str, **kwargs):
+    """经过主机限速器的 GET"""
+    with host_limiter(url).request() as call:
+        resp = scraper.get(url, **kwargs)
+        call.observe(resp)
+    return resp
+
+
+def transient_error(e: Exception) -> bool:
+    """超时、连接中断、Cloudflare 异常、5xx、408/429 和质询页值得重试，其他 4xx 不重试"""
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        resp = e.response
+        return (resp.status_code >= 500 or resp.status_code in (408, 429)
+                or (resp.status_code == 403 and bool(resp.headers.get("cf-mitigated"))))
+    return True
+
+
+class RetryScheduler:
+    """
+    页面和图片请求共用的重试调度：指数退避 + 随机抖动，避免同一批失败的请求同时重试
+    整次运行共享 RETRY_BUDGET 次重试，用完后失败直接返回，由调用方记入死信
+    限流（429/质询）时主机限速器已降速或暂停，重试请求同样经过限速器排队
+    """
+    
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.used = 0
+        self._lock = threading.Lock()
+    
+    @property
+    def exhausted(self) -> bool:
+        return self.used >= self.budget
+    
+    def wait(self, attempt: int, kind: str) -> bool:
+        """第 attempt 次重试前等待，不应再重试时返回 False"""
+        if attempt >= RETRY_ATTEMPTS:
+            return False
+        with self._lock:
+            if self.used >= self.budget:
+                return False
+            self.used += 1
+        metrics.count(f"retries.{kind}")
+        time.sleep(min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * random.uniform(0.5, 1.0))
+        return True
+
+
+retries = RetryScheduler(RETRY_BUDGET)
+
+
+def known_hash(library: Library, key: bytes) -> str | None:
+    file_hash = library.urls.get(key)
+    if file_hash and file_hash in library.registry:
+        return file_hash
+    return None
+
+
+def download_image(url: str, library: Library) -> dict | None:
+    """
+    下载到内存，边接收边计算 SHA-256
+    URL 或 ETag+Content-Length 已登记的图片不下载正文
+    返回: {"hash", "keys", "data"}，已知图片 data 为 None；重试用尽时返回 None
+    """
+    url_key = UrlIndex.url_key(url)
+    file_hash = known_hash(library, url_key)
+    if file_hash:
+        return {"hash": file_hash, "keys": [url_key], "data": None}
+    
+    attempt = 0
+    while True:
+        keys = [url_key]
+        try:
+            start = time.perf_counter()
+            sha256 = hashlib.sha256()
+            buf = bytearray()
+            with host_limiter(url).request() as call:
+                resp = scraper.get(url, timeout=60, stream=True)
+                call.observe(resp)
+                resp.raise_for_status()
+                
+                etag = resp.headers.get("ETag")
+                if etag:
+                    keys.append(UrlIndex.validator_key(etag, resp.headers.get("Content-Length", "")))
+                    file_hash = known_hash(library, keys[1])
+                    if file_hash:
+                        resp.close()
+                        return {"hash": file_hash, "keys": keys, "data": None}
+                
+                for chunk in resp.iter_content(65536):
+                    sha256.update(chunk)
+                    buf += chunk
+            metrics.observe("image.download", time.perf_counter() - start)
+            metrics.count("bytes.image_in", len(buf))
+            return {"hash": sha256.hexdigest(), "keys": keys, "data": bytes(buf)}
+        except Exception as e:
+            if not transient_error(e) or not retries.wait(attempt, "image"):
+                metrics.count("errors.download")
+                print(f"❌ 下载失败: {e}")
+                return None
+            attempt += 1
+            print(f"🔁 下载失败 ({e})，第 {attempt} 次重试: {url}")
+
+
+def download_images(page_id: int, images: list, library: Library) -> list:
+    """
+    并发下载一个页面的图片，结果按 index 顺序返回
+    下载失败的图片保留为 {"url", "index", "total", "failed": True}，由调用方记入死信
+    """
+    jobs = [(img, download_pool.submit(download_image, img["url"], library))
+            for img in images[:BATCH_SIZE]]
+    
+    downloaded = []
+    for img, future in jobs:
+        result = future.result() or {"failed": True}
+        result.update({"url": img["url"], "index": img["index"], "total": len(images)})
+        downloaded.append(result)
+    
+    ok_count = sum(1 for img in downloaded if not img.get("failed"))
+    print(f"📥 [{page_id}] 下载完成 {ok_count}/{len(jobs)}")
+    return downloaded
+
+
+def decode_factor(data: bytes, size: tuple | None) -> int | None:
+    """
+    满足 DECODE_PIXEL_BUDGET 的最小缩小倍数（1/2/4/8），无法在预算内解码时返回 None
+    文件头中读不到尺寸的格式按 1 处理，超出预算时由 OpenCV 的像素上限在解码前拒绝
+    """
+    if size is None or size[0] * size[1] <= DECODE_PIXEL_BUDGET:
+        return 1
+    if data[:2] != b"\xff\xd8":
+        return None
+    for factor, _ in reversed(REDUCED_DECODE):
+        if size[0] * size[1] / factor ** 2 <= DECODE_PIXEL_BUDGET:
+            return factor
+    return None
+
+
+def load_image(data: bytes) -> tuple:
+    """
+    有内存上限的解码，返回 (img, action)
+    action: "full" | "reduced"（解码时缩小）| "capped"（解码后缩到 MAX_OUTPUT_SIDE，只限制输出大小，
+            不限制解码内存）| "rejected"（超出像素预算）| "failed"
+    """
+    factor = decode_factor(data, image_size(data))
+    if factor is None:
+        return None, "rejected"
+    try:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), dict(REDUCED_DECODE).get(factor, cv2.IMREAD_COLOR))
+    except cv2.error as e:
+        # OPENCV_IO_MAX_IMAGE_PIXELS 的检查在读完文件头、分配内存之前
+        return None, "rejected" if "validateInputImageSize" in str(e) else "failed"
+    if img is None:
+        return None, "failed"
+    
+    action = "reduced" if factor > 1 else "full"
+    h, w = img.shape[:2]
+    if max(w, h) > MAX_OUTPUT_SIDE:
+        scale = MAX_OUTPUT_SIDE / max(w, h)
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                         interpolation=cv2.INTER_AREA)
+        if action == "full":
+            action = "capped"
+    return img, action
+
+
+def decode_image(data: bytes) -> np.ndarray | None:
+    return load_image(data)[0]
+
+
+def encode_webp(img: np.ndarray, quality: int) -> bytes | None:
+    try:
+        ok, buf = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, quality])
+        return buf.tobytes() if ok else None
+    except:
+        return None
+
+
+def convert_to_webp(img: np.ndarray, source: bytes) -> tuple:
+    """
+    自适应 WebP 编码，返回 (webp, stats)，失败时为 (None, None)
+    stats: {"baseline": 固定质量的大小, "size", "quality", "mode": "fixed" | "search" | "passthrough"}
+    """
+    baseline = encode_webp(img, WEBP_QUALITY)
+    if baseline is None:
+        return None, None
+    
+    best, quality, mode = baseline, WEBP_QUALITY, "fixed"
+    if len(baseline) > WEBP_TARGET_BYTES:
+        mode = "search"
+        found = None
+        lo, hi = WEBP_MIN_QUALITY, WEBP_QUALITY - 1
+        for _ in range(WEBP_SEARCH_STEPS):
+            if lo > hi:
+                break
+            mid = (lo + hi) // 2
+            data = encode_webp(img, mid)
+            if data is None:
+                break
+            if len(data) <= WEBP_TARGET_BYTES:
+                found = (data, mid)
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        # 最低质量仍超出预算时用最低质量
+        if found is None:
+            found = (encode_webp(img, WEBP_MIN_QUALITY), WEBP_MIN_QUALITY)
+        if found[0] is not None and len(found[0]) < len(best):
+            best, quality = found
+    
+    # 源文件已是 WebP 且更小：不重新编码（解码时缩小过的图片不传入 source）
+    if source and source[:4] == b"RIFF" and source[8:12] == b"WEBP" and len(source) <= len(best):
+        best, quality, mode = source, None, "passthrough"
+    
+    return best, {"baseline": len(baseline), "size": len(best), "quality": quality, "mode": mode}
+
+
+def convert_to_avif(img: np.ndarray) -> bytes | None:
+    try:
+        ok, buf = cv2.imencode(".avif", img, [cv2.IMWRITE_AVIF_QUALITY, AVIF_QUALITY])
+        return buf.tobytes() if ok else None
+    except:
+        return None
+
+
+def perceptual_hash(img: np.ndarray) -> int:
+    """64 位 dHash：9x8 灰度缩略图中相邻像素的明暗关系"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+
+# sRGB → 线性亮度的查表（近似 OpenCV 8 位 BGR2LAB 的 L 通道：OpenCV 取整到整数，单个颜色最大偏差实测 1.5，
+# 随机 100x100 图片的平均值偏差 < 0.15）
+SRGB_TO_LINEAR = np.where(
+    np.arange(256) <= 10,
+    np.arange(256) / 255.0 / 12.92,
+    ((np.arange(256) / 255.0 + 0.055) / 1.055) ** 2.4
+).astype(np.float32)
+# 缩小解码的倍数，选最大的使短边仍 ≥ 100 像素
+REDUCED_DECODE = [(8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2)]
+THUMB_SIDE = 100
+
+
+def batch_luminance(thumbs: np.ndarray) -> np.ndarray:
+    """
+    一批 BGR 缩略图 (N, H, W, 3) 的平均 L 值（0-255，与 LAB L 通道同一刻度）
+    逐像素计算 L 后再求均值，整批一次向量化完成
+    """
+    lin = SRGB_TO_LINEAR[thumbs]
+    y = lin @ np.array([0.072169, 0.715160, 0.212671], np.float32)
+    l = np.where(y > 0.008856, 116 * np.cbrt(y) - 16, 903.3 * y) * (255 / 100)
+    return l.reshape(len(thumbs), -1).mean(axis=1)
+
+
+def classify(width: int, height: int, brightness: float) -> dict:
+    orientation = "h" if width >= height else "v"
+    tone = "d" if brightness < BRIGHTNESS_THRESHOLD else "l"
+    return {"folder": orientation + tone, "width": width, "height": height, "brightness": float(brightness)}
+
+
+def analyze_image(img: np.ndarray) -> dict | None:
+    """分析图片，返回分类文件夹"""
+    try:
+        h, w = img.shape[:2]
+        if w < 10 or h < 10:
+            return None
+        
+        resized = cv2.resize(img, (100, 100))
+        lab = cv2.cvtColor(resized, cv2.COLOR_BGR2LAB)
+        return classify(w, h, lab[:, :, 0].mean())
+    except Exception as e:
+        print(f"❌ 分析失败: {e}")
+        return None
+
+
+def image_size(data: bytes) -> tuple | None:
+    """只读文件头获取 (宽, 高)，支持 JPEG/PNG/GIF/WebP，未识别返回 None"""
+    try:
+        if data[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", data[16:24])
+        if data[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", data[6:10])
+        if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+            chunk = data[12:16]
+            if chunk == b"VP8 ":
+                w, h = struct.unpack("<HH", data[26:30])
+                return w & 0x3FFF, h & 0x3FFF
+            if chunk == b"VP8L":
+                bits = int.from_bytes(data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+            return None
+        if data[:2] == b"\xff\xd8":
+            pos = 2
+            while pos + 9 < len(data):
+                if data[pos] != 0xFF:
+                    pos += 1
+                    continue
+                marker = data[pos + 1]
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7 or marker == 0xFF:
+                    pos += 1 if marker == 0xFF else 2
+                    continue
+                length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+                # SOF0-SOF15，排除 DHT(C4)/JPG(C8)/DAC(CC)
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    h, w = struct.unpack(">HH", data[pos + 5:pos + 9])
+                    return w, h
+                pos += 2 + length
+    except struct.error:
+        pass
+    return None
+
+
+def decode_thumbnail(data: bytes) -> tuple | None:
+    """
+    缩小解码（JPEG 在 DCT 阶段直接按 1/2、1/4、1/8 解码）并缩放到 100x100
+    返回 (缩略图, 原图宽, 原图高)，失败返回 None
+    原图尺寸取自文件头；解码按 EXIF 旋转后宽高对调时同样对调
+    """
+    size = image_size(data)
+    min_factor = decode_factor(data, size)
+    if min_factor is None:
+        return None
+    flag, factor = cv2.IMREAD_COLOR, 1
+    if size:
+        for factor, reduced_flag in REDUCED_DECODE:
+            if min(size) // factor >= THUMB_SIDE or factor == min_factor:
+                flag = reduced_flag
+                break
+        else:
+            factor = 1
+    try:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), flag)
+    except cv2.error:
+        return None
+    if img is None:
+        return None
+    h, w = img.shape[:2]
+    if size is None:
+        size = (w * factor, h * factor)
+    elif (w >= h) != (size[0] >= size[1]) and abs(w - h) > 1:
+        size = (size[1], size[0])
+    return cv2.resize(img, (THUMB_SIDE, THUMB_SIDE), interpolation=cv2.INTER_AREA), size[0], size[1]
+
+
+def classify_images(blobs: list) -> list:
+    """
+    只做分类的批量路径：缩小解码 + 整批向量化计算亮度
+    与 decode_image + analyze_image 的文件夹一致，亮度在阈值附近 ±2 以内可能不同
+    （缩小解码是块平均，原函数是对全图线性插值采样；亮度核与 OpenCV LAB 也有取整差异，
+    scraper_bench.py classify 在合成 JPEG 语料上实测最大偏差 1.53）
+    返回与 blobs 等长的列表，无法解码或过小的为 None
+    """
+    thumbs = [decode_thumbnail(data) for data in blobs]
+    valid = [t for t in thumbs if t and t[1] >= 10 and t[2] >= 10]
+    if not valid:
+        return [None] * len(blobs)
+    levels = iter(batch_luminance(np.stack([t[0] for t in valid])))
+    return [classify(t[1], t[2], next(levels)) if t and t[1] >= 10 and t[2] >= 10 else None
+            for t in thumbs]
+
+
+def make_thumbnails(img: np.ndarray) -> dict:
+    """从已解码的图片生成缩略图 {后缀: WebP}，长边不超过 THUMBNAIL_SIZES"""
+    h, w = img.shape[:2]
+    thumbs = {}
+    for suffix, side in THUMBNAIL_SIZES.items():
+        scale = side / max(w, h)
+        if scale >= 1:
+            continue
+        small = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+        data = encode_webp(small, THUMBNAIL_QUALITY)
+        if data is not None:
+            thumbs[suffix] = data
+    return thumbs
+
+
+def peak_rss_kb() -> int:
+    """当前进程的峰值 RSS（KB）；优先读 VmHWM，ru_maxrss 在 spawn 出的子进程中会带上父进程的峰值"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def process_image(data: bytes) -> dict:
+    """
+    CPU 进程池任务：只解码一次，同一个 ndarray 用于分类、WebP 编码和缩略图
+    返回: {"info", "webp", "extras", "encode", "pid", "seconds", "timings", "decode", "rss_kb"}，
+    失败时 info 为 None
+    extras 为附加文件 {后缀: bytes}，后缀同时记录在 info["extras"]
+    timings 为各步骤耗时 {步骤: 秒}，由主进程汇总到运行指标
+    decode 为 load_image 的处理方式，rss_kb 为该进程至今的峰值 RSS
+    """
+    start = time.perf_counter()
+    timings = {}
+    info = webp = encode = None
+    extras = {}
+    
+    def lap(step: str):
+        nonlocal start
+        now = time.perf_counter()
+        timings[step] = now - start
+        start = now
+    
+    img, action = load_image(data)
+    lap("decode")
+    if img is not None:
+        info = analyze_image(img)
+        lap("analyze")
+        if info:
+            info["phash"] = perceptual_hash(img)
+            lap("phash")
+            webp, encode = convert_to_webp(img, data if action == "full" else None)
+            lap("webp")
+            if webp is None:
+                info = None
+            else:
+                encode["source"] = len(data)
+                extras = make_thumbnails(img)
+                lap("thumbnails")
+                if ENCODE_AVIF and cv2.haveImageWriter(".avif"):
+                    avif = convert_to_avif(img)
+                    lap("avif")
+                    if avif is not None and len(avif) < len(webp):
+                        extras[".avif"] = avif
+                info["extras"] = list(extras)
+    
+    return {
+        "info": info,
+        "webp": webp,
+        "extras": extras,
+        "encode": encode,
+        "pid": os.getpid(),
+        "seconds": sum(timings.values()),
+        "timings": timings,
+        "decode": action,
+        "rss_kb": peak_rss_kb()
+    }
+
+
+# ============ 会话缓存 ============
+
+class SessionCache:
+    """
+    跨运行保存 cloudscraper 会话（含 cf_clearance 的 cookies 和对应的 User-Agent），用 Fernet 加密
+    启动时恢复并用一次轻量请求验证，cookie 过期或验证失败才重新过质询
+    记录上次过质询的耗时，用于估算复用节省的时间
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self.solve_seconds = 0.0
+        key = SESSION_KEY or os.environ.get("GH_TOKEN", "")
+        self._fernet = None
+        if Fernet and key:
+            digest = hashlib.sha256(f"scraper-session:{key}".encode("utf-8")).digest()
+            self._fernet = Fernet(base64.urlsafe_b64encode(digest))
+    
+    @property
+    def enabled(self) -> bool:
+        return self._fernet is not None
+    
+    def restore(self) -> bool:
+        """把保存的会话装入 scraper，返回是否恢复了未过期的会话"""
+        if not self._fernet or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "rb") as f:
+                data = json.loads(self._fernet.decrypt(f.read()))
+        except (InvalidToken, ValueError) as e:
+            print(f"⚠️ 会话缓存无法解密，忽略: {type(e).__name__}")
+            return False
+        
+        self.solve_seconds = data.get("solve_seconds", 0.0)
+        now = time.time()
+        clearance = [c for c in data["cookies"] if c["name"] == "cf_clearance"]
+        if any(c["expires"] and c["expires"] < now for c in clearance):
+            print("🍪 cf_clearance 已过期")
+            return False
+        
+        scraper.headers["User-Agent"] = data["user_agent"]
+        for c in data["cookies"]:
+            if c["expires"] and c["expires"] < now:
+                continue
+            scraper.cookies.set(c["name"], c["value"], domain=c["domain"], path=c["path"],
+                                expires=c["expires"], secure=c["secure"])
+        return True
+    
+    def save(self):
+        if not self._fernet:
+            return
+        data = {
+            "user_agent": scraper.headers.get("User-Agent", ""),
+            "cookies": [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path,
+                         "expires": c.expires, "secure": c.secure} for c in scraper.cookies],
+            "solve_seconds": self.solve_seconds,
+            "saved_at": time.time()
+        }
+        ensure_dir(os.path.dirname(self.path))
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(self._fernet.encrypt(json.dumps(data).encode("utf-8")))
+        os.replace(tmp_path, self.path)
+
+
+def session_valid() -> tuple:
+    """用首页做一次轻量请求（只读响应头），返回 (是否可用, 耗时)；需要过质询时耗时包含求解"""
+    start = time.perf_counter()
+    try:
+        resp = polite_get(SITE_URL + "/", timeout=60, stream=True)
+        resp.close()
+        ok = resp.status_code < 400 or resp.status_code == 404
+    except Exception as e:
+        print(f"⚠️ 会话验证失败: {e}")
+        ok = False
+    return ok, time.perf_counter() - start
+
+
+def prepare_session(session_cache: SessionCache):
+    """恢复并验证保存的会话，失效时清空 cookies 重新过质询"""
+    if not session_cache.enabled:
+        print("🍪 未启用会话缓存（缺少 cryptography 或密钥）")
+        return
+    
+    fresh_agent = scraper.headers.get("User-Agent")
+    if session_cache.restore():
+        ok, seconds = session_valid()
+        if ok:
+            saved = max(0.0, session_cache.solve_seconds - seconds)
+            print(f"🍪 复用已保存的会话，验证 {seconds:.1f}s（上次过质询 {session_cache.solve_seconds:.1f}s，"
+                  f"节省约 {saved:.1f}s）")
+            return
+        print("🍪 已保存的会话失效，重新过质询")
+        scraper.cookies.clear()
+        scraper.headers["User-Agent"] = fresh_agent
+    
+    ok, seconds = session_valid()
+    if ok:
+        session_cache.solve_seconds = seconds
+        session_cache.save()
+        print(f"🍪 新会话就绪，耗时 {seconds:.1f}s")
+
+
+# ============ 末尾发现 ============
+
+def page_exists(page_id: int, probes: list) -> bool:
+    """只读响应头判断页面是否存在（404 以外的错误会抛出）"""
+    probes[0] += 1
+    resp = polite_get(build_url(page_id), timeout=30, stream=True)
+    resp.close()
+    if resp.status_code == 404:
+        return False
+    resp.raise_for_status()
+    return True
+
+
+def discover_upper_bound(start_id: int) -> tuple | None:
+    """
+    找出当前最新的存档ID，返回 (upper_id, source, probe_count)，失败返回 None
+    优先解析 RSS/首页中本站的存档链接（相对链接或与 SITE_URL 同一主机，其他站点的链接忽略），
+    最大的ID需实际存在才采用；否则从 start_id 起指数步长探测越界点，再二分查找最后一个存在的ID
+    探测时与主循环的404规则一致：某个ID起连续 MAX_404_COUNT 个都是404才算越界，短于此的空缺
+    （已删除的页面，包括 start_id 本身）会被跳过；start_id 之后找不到存在的页面时返回 None
+    """
+    probes = [0]
+    # 可选的 [scheme:]//host 前缀，用于排除正文和友链里其他站点的同构链接
+    pattern = re.compile(r"(?:(?:https?:)?//([^/\s\"'<>]+))?/index\.php/archives/(\d+)\.html")
+    site_host = urlsplit(SITE_URL).netloc.lower()
+    
+    for path in DISCOVERY_PATHS:
+        try:
+            probes[0] += 1
+            resp = polite_get(SITE_URL + path, timeout=30)
+            resp.raise_for_status()
+        except Exception as e:
+            print(f"⚠️ 读取 {path} 失败: {e}")
+            continue
+        ids = [int(page_id) for host, page_id in pattern.findall(resp.text)
+               if not host or host.lower() == site_host]
+        if not ids:
+            continue
+        try:
+            if page_exists(max(ids), probes):
+                return max(ids), path, probes[0]
+        except Exception as e:
+            print(f"⚠️ 验证 {path} 中的最新ID失败: {e}")
+            continue
+        print(f"⚠️ {path} 中的最新ID {max(ids)} 不存在，不采用")
+    
+    known = {}
+    
+    def first_live(page_id: int) -> int | None:
+        """[page_id, page_id + MAX_404_COUNT) 中第一个存在的ID，全是404返回 None"""
+        for candidate in range(page_id, page_id + MAX_404_COUNT):
+            if candidate not in known:
+                known[candidate] = page_exists(candidate, probes)
+            if known[candidate]:
+                return candidate
+        return None
     
+    # 不变式：lo 存在，从 hi 起连续 MAX_404_COUNT 个都是404
     try:
-        resp = requests.get(url, headers=headers, timeout=30)
-        if resp.status_code == 200:
-            data = resp.json()
-            content = base64.b64decode(data["content"]).decode("utf-8")
-            return content, data["sha"]
+        lo = first_live(start_id)
+        if lo is None:
+            return None
+        step = 1
+        while (found := first_live(lo + step)) is not None:
+            lo = found
+            step *= 2
+        hi = lo + step
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            found = first_live(mid)
+            if found is None:
+                hi = mid
+            else:
+                lo = found
+        return lo, "probe", probes[0]
     except Exception as e:
-        print(f"⚠️ 获取JSON失败 {path}: {e}")
-    return None, None
+        print(f"⚠️ 探测末尾失败: {e}")
+        return None
 
 
-def github_upload(path: str, content: bytes, message: str, sha: str = None) -> bool:
-    if not GITHUB_TOKEN or not TARGET_REPO:
-        return False
-    
-    url = f"https://api.github.com/repos/{TARGET_REPO}/contents/{path}"
-    headers = {
-        "Authorization": f"token {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
+# ============ 本地处理 ============
+
+def fetch_page(page_id: int, library: Library, page_cache: PageCache,
+               cpu_pool: ProcessPoolExecutor) -> tuple:
+    """
+    抓取单个页面、下载图片并提交到 CPU 进程池（可在线程中并发执行，不修改共享状态）
+    返回: (status, downloaded)
+    status: "ok" | "video" | "404" | "error"
+    downloaded: [{"url", "index", "total", "hash", "keys", "known", "future"}]，已知重复的 future 为 None，
+                下载失败的只有 {"url", "index", "total", "failed"}
+    """
+    # 爬取图片
+    images, status = scrape_images(page_id, page_cache)
     
-    data = {
-        "message": message,
-        "content": base64.b64encode(content).decode("utf-8"),
-        "branch": TARGET_BRANCH
-    }
-    if sha:
-        data["sha"] = sha
+    if status != "ok":
+        return status, []
     
-    try:
-        resp = requests.put(url, headers=headers, json=data, timeout=60)
-        return resp.status_code in [200, 201]
-    except Exception as e:
-        print(f"❌ 上传失败 {path}: {e}")
-        return False
-
-
-def get_remote_json(path: str, default=None) -> dict:
-    content, _ = github_get_json(path)
-    if content:
-        try:
-            return json.loads(content)
-        except:
-            pass
-    return default if default is not None else {}
+    return "ok", submit_images(page_id, images, library, cpu_pool)
 
 
-def save_remote_json(path: str, data: dict, msg: str) -> bool:
-    sha = github_get_sha(path)
-    content = json.dumps(data, ensure_ascii=False, indent=2).encode("utf-8")
-    return github_upload(path, content, msg, sha)
+def submit_images(page_id: int, images: list, library: Library, cpu_pool: ProcessPoolExecutor) -> list:
+    """下载图片并把新图片提交到 CPU 进程池"""
+    downloaded = download_images(page_id, images, library)
+    
+    for img in downloaded:
+        if img.get("failed"):
+            continue
+        data = img.pop("data")
+        img["known"] = data is None
+        if img["known"] or img["hash"] in library.registry:
+            img["future"] = None
+        else:
+            img["future"] = cpu_pool.submit(process_image, data)
+    
+    return downloaded
 
 
-def batch_upload_to_github(upload_queue: list, hash_registry: dict, 
-                           folder_counts: dict, last_id: int) -> bool:
-    """批量上传所有文件到GitHub"""
-    if not upload_queue:
-        print("📭 没有需要上传的文件")
-        return True
-    
+def process_page_local(page_id: int, fetched: tuple, library: Library,
+                       upload_queue: list, journal: CrawlJournal, run_stats: dict) -> str:
+    """
+    按ID顺序处理已抓取的页面（去重、编号），CPU 结果按提交顺序取回
+    每张图片和页面完成都写入恢复日志
+    返回: "success" | "video" | "404" | "error"
+    """
     print(f"\n{'='*50}")
-    print(f"📤 开始批量上传 {len(upload_queue)} 个文件")
-    print(f"{'='*50}\n")
+    print(f"📂 页面 ID: {page_id}")
+    print(f"{'='*50}")
     
-    success_count = 0
-    fail_count = 0
+    status, downloaded = fetched
     
-    for idx, item in enumerate(upload_queue, 1):
-        local_path = item["local_path"]
-        remote_path = item["remote_path"]
-        file_hash = item["hash"]
-        
-        print(f"[{idx}/{len(upload_queue)}] {remote_path}", end=" ")
-        
-        try:
-            with open(local_path, "rb") as f:
-                content = f.read()
-            
-            if github_upload(remote_path, content, f"Add {remote_path}"):
-                hash_registry[file_hash] = remote_path.replace(f"{IMAGES_DIR}/", "")
-                success_count += 1
-                print("✅")
-            else:
-                fail_count += 1
-                print("❌")
-                folder = remote_path.split("/")[-2]
-                if folder in folder_counts:
-                    folder_counts[folder] -= 1
-        except Exception as e:
-            fail_count += 1
-            print(f"❌ {e}")
+    if status != "ok":
+        if status == "video":
+            journal.append({"t": "page", "id": page_id, "status": status})
+        return status
     
-    print(f"\n📊 上传完成: 成功 {success_count}, 失败 {fail_count}")
+    new_count = 0
     
-    # 上传元数据
-    if success_count > 0:
-        print("\n📝 更新元数据...")
+    for img in downloaded:
+        if img.get("failed"):
+            print(f"💀 [{img['index']}/{img['total']}] 下载失败，记入死信: {img['url']}")
+            if library.dead_letter.add_image(img["url"], page_id, img["index"]):
+                journal.append({"t": "dead", "page": page_id, "url": img["url"], "index": img["index"]})
+            continue
+        
+        file_hash = img["hash"]
+        keys = [k.hex() for k in img["keys"]]
+        
+        print(f"🔍 [{img['index']}/{img['total']}] 处理中...")
+        
+        if img["future"] is None:
+            print(f"  ⏭️ 跳过{'已知来源' if img['known'] else '重复'}")
+            metrics.count("images.known" if img["known"] else "images.duplicate")
+            register_alias(library, file_hash, img["keys"], file_hash)
+            journal.append({"t": "alias", "page": page_id, "hash": file_hash, "keys": keys,
+                            "target": file_hash})
+            continue
+        
+        with metrics.timer("cpu.wait"):
+            result = img["future"].result()
+        
+        record_worker(run_stats, result)
+        
+        info = result["info"]
+        if not info:
+            metrics.count("images.undecodable")
+            continue
+        
+        # 预取中的其他页面可能已登记相同图片
+        target = file_hash if file_hash in library.registry else None
         
-        if save_remote_json(f"{IMAGES_DIR}/hash_registry.json", hash_registry,
-                           f"Update hash_registry (+{success_count})"):
-            print("  ✅ hash_registry.json")
+        # 近似重复：重新编码/缩放过的同一张图，登记为已有条目的别名
+        if target is None and PHASH_THRESHOLD >= 0:
+            match = library.phash_lookup.find(info["phash"], PHASH_THRESHOLD)
+            if match:
+                distance, target = match
+                print(f"  ⏭️ 跳过近似重复 (距离 {distance} → {library.registry.get(target)})")
+                run_stats["near_duplicates"] += 1
+        elif target:
+            print(f"  ⏭️ 跳过重复")
+        
+        if target:
+            metrics.count("images.duplicate")
+            register_alias(library, file_hash, img["keys"], target)
+            journal.append({"t": "alias", "page": page_id, "hash": file_hash, "keys": keys,
+                            "target": target})
+            continue
         
-        if save_remote_json(f"{IMAGES_DIR}/count.json", folder_counts, "Update count"):
-            print("  ✅ count.json")
+        # 先落盘再记日志，恢复时日志中的图片一定有对应文件
+        print(f"  📐 {info['width']}x{info['height']} L={info['brightness']:.1f} → {info['folder']}")
+        with open(spool_path(file_hash), "wb") as f:
+            f.write(result["webp"])
+        for suffix, data in result["extras"].items():
+            with open(spool_path(file_hash, suffix), "wb") as f:
+                f.write(data)
+        record_encode(run_stats, result)
         
-        # 更新进度
-        progress = get_remote_json("progress.json", {"last_id": START_ID - 1})
-        progress["last_id"] = last_id
-        if save_remote_json("progress.json", progress, f"Update progress to {last_id}"):
-            print("  ✅ progress.json")
+        remote_path = register_image(library, upload_queue, file_hash, img["keys"], info,
+                                     len(result["webp"]))
+        journal.append({"t": "image", "page": page_id, "hash": file_hash, "keys": keys,
+                        "info": info, "size": len(result["webp"])})
+        new_count += 1
+        print(f"  💾 {remote_path}")
     
-    return fail_count == 0
+    journal.append({"t": "page", "id": page_id, "status": "success"})
+    print(f"✅ 页面 {page_id} 完成，新增 {new_count} 张")
+    return "success"
 
 
-# ============ 工具函数 ============
+def retry_dead_letter(library: Library, page_cache: PageCache, cpu_pool: ProcessPoolExecutor,
+                      upload_queue: list, journal: CrawlJournal, run_stats: dict):
+    """
+    正常爬取前先重试死信：整页失败的页面重新处理，单张失败的图片按页面分组重新下载
+    成功的条目移出死信，仍失败的累计一次运行次数；结果随下一批一起提交
+    """
+    dead = library.dead_letter
+    if not dead.size:
+        return
+    print(f"💀 先重试死信: {len(dead.pages)} 个页面, {len(dead.images)} 张图片")
+    
+    for page_id in sorted(int(key) for key in dead.pages):
+        fetched = fetch_page(page_id, library, page_cache, cpu_pool)
+        if fetched[0] == "error":
+            dead.add_page(page_id)
+            continue
+        dead.remove_page(page_id)
+        process_page_local(page_id, fetched, library, upload_queue, journal, run_stats)
+    
+    by_page = {}
+    for url, entry in dead.images.items():
+        by_page.setdefault(entry["page"], []).append({"url": url, "index": entry["index"]})
+    for page_id, images in sorted(by_page.items()):
+        downloaded = submit_images(page_id, images, library, cpu_pool)
+        for img in downloaded:
+            if not img.get("failed"):
+                dead.remove_image(img["url"])
+        # 仍然失败的图片在这里再次记入死信
+        process_page_local(page_id, ("ok", downloaded), library, upload_queue, journal, run_stats)
+    
+    print(f"💀 死信重试完成，剩余 {len(dead.pages)} 个页面, {len(dead.images)} 张图片\n")
 
-def build_url(page_id: int) -> str:
-    return f"https://img.hyun.cc/index.php/archives/{page_id}.html"
 
+def new_run_stats() -> dict:
+    return {
+        "workers": {},
+        "near_duplicates": 0,
+        "encode": {"source": 0, "baseline": 0, "size": 0, "avif": 0, "thumbnails": 0,
+                   "fixed": 0, "search": 0, "passthrough": 0}
+    }
 
-def get_file_hash(filepath: str) -> str:
-    sha256 = hashlib.sha256()
-    with open(filepath, "rb") as f:
-        for chunk in iter(lambda: f.read(8192), b""):
-            sha256.update(chunk)
-    return sha256.hexdigest()
 
+def record_worker(run_stats: dict, result: dict):
+    """累计 CPU 进程的吞吐和峰值内存，各步骤耗时计入运行指标"""
+    stats = run_stats["workers"].setdefault(result["pid"], {"count": 0, "seconds": 0.0, "rss_kb": 0})
+    stats["count"] += 1
+    stats["seconds"] += result["seconds"]
+    stats["rss_kb"] = max(stats["rss_kb"], result["rss_kb"])
+    for step, seconds in result["timings"].items():
+        metrics.observe(f"cpu.{step}", seconds)
+    metrics.count(f"decode.{result['decode']}")
+    metrics.gauge("worker.peak_rss_mb", result["rss_kb"] / 1024)
+    if result["decode"] == "rejected":
+        print(f"  🐘 图片像素超出解码预算 ({DECODE_PIXEL_BUDGET // 1000000}MP)，跳过")
+    elif result["decode"] in ("reduced", "capped"):
+        print(f"  🐘 大图已缩小解码 → {result['info']['width']}x{result['info']['height']}"
+              if result["info"] else "  🐘 大图已缩小解码")
 
-def ensure_dir(path: str):
-    Path(path).mkdir(parents=True, exist_ok=True)
 
+def record_encode(run_stats: dict, result: dict):
+    """累计实际保存的图片的编码统计"""
+    encode = result["encode"]
+    totals = run_stats["encode"]
+    metrics.count("images.new")
+    metrics.count("bytes.webp_out", encode["size"])
+    for key in ["source", "baseline", "size"]:
+        totals[key] += encode[key]
+    totals[encode["mode"]] += 1
+    totals["avif"] += len(result["extras"].get(".avif", b""))
+    totals["thumbnails"] += sum(len(result["extras"].get(suffix, b"")) for suffix in THUMBNAIL_SIZES)
+    if encode["mode"] != "fixed":
+        print(f"  🗜️ {encode['mode']}: {encode['baseline'] // 1024}KB → {encode['size'] // 1024}KB")
 
-# ============ 图片处理 ============
 
-def scrape_images(url: str) -> tuple:
-    """
-    爬取页面中的图片链接
-    返回: (images_list, status)
-    status: "ok" | "video" | "404" | "error"
-    """
-    print(f"🌐 爬取: {url}")
-    
-    try:
-        resp = scraper.get(url, timeout=30)
-        
-        # 检查404
-        if resp.status_code == 404:
-            return [], "404"
-        
-        resp.raise_for_status()
-        resp.encoding = 'utf-8'
-    except requests.exceptions.HTTPError as e:
-        if "404" in str(e):
-            return [], "404"
-        print(f"❌ 请求失败: {e}")
-        return [], "error"
-    except Exception as e:
-        print(f"❌ 请求失败: {e}")
-        return [], "error"
-    
-    soup = BeautifulSoup(resp.text, "lxml")
-    images = []
-    
-    for idx, link in enumerate(soup.find_all("a", {"data-fancybox": True}), 1):
-        href = link.get("href", "")
-        if href.startswith("http"):
-            images.append({"url": href, "index": idx})
+def print_run_stats(run_stats: dict):
+    if run_stats["workers"]:
+        print(f"\n👷 CPU 进程吞吐:")
+        for pid, stats in sorted(run_stats["workers"].items()):
+            rate = stats["count"] / stats["seconds"] if stats["seconds"] else 0
+            print(f"   PID {pid}: {stats['count']} 张, {stats['seconds']:.1f}s, {rate:.1f} 张/s, "
+                  f"峰值 RSS {stats['rss_kb'] / 1024:.0f}MB")
+    print(f"🪞 近似重复跳过: {run_stats['near_duplicates']} 张")
     
-    if not images:
-        # 没有图片，可能是视频页面
-        print(f"🎬 无图片（视频页面），跳过")
-        return [], "video"
+    for limiter in list(_host_limiters.values()):
+        print(f"🚦 {limiter.host}: {limiter.requests} 次请求, 当前 {limiter.rate:.1f} 请求/s "
+              f"(峰值 {limiter.peak_rate:.1f}), 并发 {int(limiter.limit)}, 退避 {len(limiter.events)} 次")
+        for event in limiter.events[-5:]:
+            print(f"   ↘ {event['reason']}: {event['rate']:.1f} 请求/s, 并发 {event['limit']}")
     
-    print(f"📷 找到 {len(images)} 张图片")
-    return images, "ok"
+    encode = run_stats["encode"]
+    if encode["size"]:
+        mb = 1048576
+        print(f"🗜️ 编码: 原图 {encode['source'] / mb:.1f}MB → WebP {encode['size'] / mb:.1f}MB "
+              f"(固定质量 {WEBP_QUALITY} 为 {encode['baseline'] / mb:.1f}MB, "
+              f"节省 {(encode['baseline'] - encode['size']) / mb:.1f}MB)")
+        print(f"   固定质量 {encode['fixed']} 张, 质量搜索 {encode['search']} 张, 直通 {encode['passthrough']} 张"
+              + (f", AVIF {encode['avif'] / mb:.1f}MB" if encode["avif"] else ""))
+        print(f"   缩略图 {encode['thumbnails'] / mb:.1f}MB")
 
 
-def download_image(url: str, save_path: str) -> bool:
-    try:
-        resp = scraper.get(url, timeout=60, stream=True)
-        resp.raise_for_status()
-        with open(save_path, "wb") as f:
-            for chunk in resp.iter_content(8192):
-                f.write(chunk)
-        return True
-    except Exception as e:
-        print(f"❌ 下载失败: {e}")
-        return False
+# ============ 重新分桶 ============
 
+def backfill_features(library: Library, slots: dict, listings: dict) -> int:
+    """为没有特征的已登记图片下载仓库中的 WebP 计算特征（同时补上文件夹索引中缺失的条目），返回补齐的数量"""
+    missing = [(slot, owners[0]) for slot, owners in slots.items()
+               if not any(library.features.lookup(bytes.fromhex(h)) for h in owners)]
+    if not missing:
+        return 0
+    
+    print(f"🧮 补算 {len(missing)} 张图片的特征...")
+    filled = 0
+    for i in range(0, len(missing), BATCH_SIZE):
+        chunk = missing[i:i + BATCH_SIZE]
+        with ThreadPoolExecutor(max_workers=UPLOAD_CONCURRENCY) as pool:
+            blobs = list(pool.map(lambda item: github.get_blob(listings[item[0][0]][f"{item[0][1]}.webp"]),
+                                  chunk))
+        for (slot, file_hash), blob, info in zip(chunk, blobs, classify_images(blobs)):
+            if info:
+                library.features.add(file_hash, info)
+                folder, num = slot
+                if library.folder_indexes[folder].get(num) is None:
+                    info["extras"] = [suffix for suffix in slot_files(listings[folder], num)
+                                      if suffix in VARIANT_CODES]
+                    library.set_index_entry(folder, num, index_entry(info, len(blob), file_hash))
+                filled += 1
+    return filled
 
-def convert_to_webp(input_path: str, output_path: str) -> bool:
-    try:
-        img = cv2.imread(input_path)
-        if img is None:
-            return False
-        cv2.imwrite(output_path, img, [cv2.IMWRITE_WEBP_QUALITY, 85])
-        return True
-    except:
-        return False
 
+def slot_files(listing: dict, num: int) -> dict:
+    """同一编号的全部文件 {后缀: sha}（主文件 .webp 及附加格式）"""
+    prefix = f"{num}."
+    return {name[len(prefix) - 1:]: sha for name, sha in listing.items() if name.startswith(prefix)}
 
-def analyze_image(path: str) -> dict | None:
-    """分析图片，返回分类文件夹"""
-    try:
-        img = cv2.imread(path)
-        if img is None:
-            return None
-        
-        h, w = img.shape[:2]
-        if w < 10 or h < 10:
-            return None
-        
-        orientation = "h" if w >= h else "v"
-        
-        resized = cv2.resize(img, (100, 100))
-        lab = cv2.cvtColor(resized, cv2.COLOR_BGR2LAB)
-        avg_l = lab[:, :, 0].mean()
-        brightness = "d" if avg_l < BRIGHTNESS_THRESHOLD else "l"
-        
-        folder = orientation + brightness
-        print(f"  📐 {w}x{h} L={avg_l:.1f} → {folder}")
-        
-        return {"folder": folder}
-    except Exception as e:
-        print(f"❌ 分析失败: {e}")
-        return None
 
+def plan_rebucket(targets: dict, listings: dict) -> tuple:
+    """
+    计算移动方案，各文件夹编号保持从 1 连续：
+    留下的图片不动，迁入的图片和超出新数量的编号依次填进空位
+    返回 ({源位置: 目标位置}, {文件夹: 新数量})
+    """
+    stay = {f: [] for f in FOLDERS}
+    arrivals = {f: [] for f in FOLDERS}
+    for folder in FOLDERS:
+        for name in listings[folder]:
+            if not re.fullmatch(r"\d+\.webp", name):
+                continue
+            num = int(name.split(".")[0])
+            target = targets.get((folder, num), folder)
+            (stay if target == folder else arrivals)[target].append((folder, num))
+    
+    moves = {}
+    counts = {}
+    for folder in FOLDERS:
+        counts[folder] = len(stay[folder]) + len(arrivals[folder])
+        kept = {num for _, num in stay[folder] if num <= counts[folder]}
+        free = [n for n in range(1, counts[folder] + 1) if n not in kept]
+        incoming = sorted(slot for slot in stay[folder] if slot[1] > counts[folder]) + sorted(arrivals[folder])
+        for slot, num in zip(incoming, free):
+            moves[slot] = (folder, num)
+    return moves, counts
 
-# ============ 本地处理 ============
 
-def process_page_local(page_id: int, hash_registry: dict, folder_counts: dict, 
-                       upload_queue: list) -> str:
+def rebucket(backfill: bool = False, dry_run: bool = False):
     """
-    本地处理单个页面
-    返回: "success" | "video" | "404" | "error"
+    只用已存的分类特征按当前 BRIGHTNESS_THRESHOLD / 方向规则重新分桶，
+    文件移动（引用原 blob，不重新上传）、注册表和计数在同一次提交中完成
+    没有特征的图片留在原处，--backfill 时先从仓库下载 WebP 补算
     """
-    url = build_url(page_id)
+    print("=" * 60)
+    print(f"🗃️ 重新分桶 (亮度阈值 {BRIGHTNESS_THRESHOLD})")
+    print("=" * 60)
+    start = time.perf_counter()
     
-    print(f"\n{'='*50}")
-    print(f"📂 页面 ID: {page_id}")
-    print(f"{'='*50}")
+    library = Library(github)
+    try:
+        library.load()
+        library.registry.preload()
+        library.features.preload()
+        head = github.head()
+        listings = {f: {name: sha for name, sha in github.list_tree(f"{IMAGES_DIR}/{f}", head).items()
+                        if re.fullmatch(r"\d+\..+", name)}
+                    for f in FOLDERS}
+    except GitHubError as e:
+        print(f"❌ 读取远程状态失败: {e}")
+        return
     
-    ensure_dir(TEMP_DIR)
+    # 列表中最大编号小于 count.json 说明列表不完整，按它重新编号会覆盖未列出的图片
+    for folder in FOLDERS:
+        listed = max((int(name.split(".")[0]) for name in listings[folder]), default=0)
+        if listed < library.folder_counts[folder]:
+            print(f"❌ {folder} 列表只到 {listed}，count.json 为 {library.folder_counts[folder]}，"
+                  f"列表可能不完整，放弃重新分桶")
+            return
     
-    # 爬取图片
-    images, status = scrape_images(url)
+    # 位置 → 登记在该位置的哈希（近似重复的哈希与原图共享位置）；增量记录覆盖基础分片
+    slots = {}
+    for key, (folder_idx, num) in dict(library.registry.items()).items():
+        slot = (FOLDERS[folder_idx], num)
+        if f"{num}.webp" in listings[slot[0]]:
+            slots.setdefault(slot, []).append(key.hex())
+    
+    backfilled = backfill_features(library, slots, listings) if backfill else 0
+    if backfill:
+        print(f"🧮 已补算 {backfilled} 张")
+    
+    targets = {}
+    unknown = 0
+    for slot, owners in slots.items():
+        feature = next(filter(None, (library.features.lookup(bytes.fromhex(h)) for h in owners)), None)
+        if feature is None:
+            unknown += 1
+            continue
+        targets[slot] = classify(*feature)["folder"]
+    
+    moves, counts = plan_rebucket(targets, listings)
+    for folder in FOLDERS:
+        images = sum(1 for name in listings[folder] if re.fullmatch(r"\d+\.webp", name))
+        print(f"   {folder}: {images} → {counts[folder]}")
+    print(f"📦 需要移动 {len(moves)} 个文件，{unknown} 张没有特征保持不动")
+    
+    if dry_run or (not moves and not backfilled):
+        print(f"\n🏁 完成（未提交），耗时 {time.perf_counter() - start:.1f}s")
+        return
+    
+    files = {}
+    for (src_folder, src_num), (dst_folder, dst_num) in moves.items():
+        for suffix, sha in slot_files(listings[src_folder], src_num).items():
+            files[f"{IMAGES_DIR}/{dst_folder}/{dst_num}{suffix}"] = sha
+        for file_hash in slots.get((src_folder, src_num), []):
+            library.registry[file_hash] = f"{dst_folder}/{dst_num}.webp"
+    # 源位置和目标位置上没有被新文件覆盖的旧文件（含缩略图等附加文件）删除
+    for folder, num in list(moves) + list(moves.values()):
+        for suffix in slot_files(listings[folder], num):
+            files.setdefault(f"{IMAGES_DIR}/{folder}/{num}{suffix}", None)
     
+    # 索引条目随文件移动（先读出全部移动的条目再写入），长度截到新数量
+    indexes = library.folder_indexes
+    moved = {dst: indexes[src[0]].get(src[1]) for src, dst in moves.items()}
+    for (folder, num), entry in moved.items():
+        indexes[folder].set(num, entry)
+    for folder in FOLDERS:
+        indexes[folder].truncate(counts[folder])
+    
+    library.folder_counts = counts
+    files.update(library.metadata_files(library.progress["last_id"]))
+    
+    if github_commit_files(files, f"Rebucket {len(moves)} images (threshold {BRIGHTNESS_THRESHOLD})"):
+        print(f"📤 已提交: 移动 {len(moves)} 个文件, 耗时 {time.perf_counter() - start:.1f}s")
+    else:
+        print("❌ 提交失败，仓库保持不变")
+    print("\n🏁 完成")
+
+
+# ============ 分片爬取与合并 ============
+
+def process_shard_page(page_id: int, fetched: tuple, library: Library, shard: dict,
+                       run_stats: dict) -> str:
+    """
+    分片模式下处理一个页面：新图片按哈希命名放入暂存文件，记录写入分片清单，不编号
+    返回: "success" | "error"（范围内的404和视频页面都算处理完成）
+    """
+    status, downloaded = fetched
+    if status in ["video", "404"]:
+        return "success"
     if status != "ok":
-        return status
+        return "error"
     
     new_count = 0
-    
-    for img in images[:BATCH_SIZE]:
-        idx = img["index"]
-        temp_path = os.path.join(TEMP_DIR, f"temp_{page_id}_{idx}")
-        
-        print(f"📥 [{idx}/{len(images)}] 下载中...")
-        
-        if not download_image(img["url"], temp_path):
+    for img in downloaded:
+        # 分片模式没有死信列表，下载失败的图片与之前一样跳过
+        if img.get("failed"):
             continue
+        file_hash = img["hash"]
+        record = {"page": page_id, "hash": file_hash, "keys": [k.hex() for k in img["keys"]]}
         
-        # 检查重复
-        file_hash = get_file_hash(temp_path)
-        if file_hash in hash_registry:
-            print(f"  ⏭️ 跳过重复")
-            os.remove(temp_path)
+        if img["future"] is None or file_hash in shard["hashes"]:
+            shard["manifest"]["records"].append({"t": "alias", **record, "target": file_hash})
             continue
         
-        # 分析图片
-        info = analyze_image(temp_path)
+        result = img["future"].result()
+        record_worker(run_stats, result)
+        info = result["info"]
         if not info:
-            os.remove(temp_path)
             continue
         
-        # 确定目标路径
-        target_folder = info["folder"]
-        folder_counts[target_folder] += 1
-        new_num = folder_counts[target_folder]
+        # 近似重复：同时比对图库和本分片已暂存的图片
+        if PHASH_THRESHOLD >= 0:
+            matches = [m for m in [library.phash_lookup.find(info["phash"], PHASH_THRESHOLD),
+                                   shard["phash"].find(info["phash"], PHASH_THRESHOLD)] if m]
+            if matches:
+                distance, target = min(matches)
+                print(f"  ⏭️ [{page_id}] 跳过近似重复 (距离 {distance})")
+                run_stats["near_duplicates"] += 1
+                shard["manifest"]["records"].append({"t": "alias", **record, "target": target})
+                continue
         
-        # 本地保存
-        local_folder = os.path.join(LOCAL_DIR, IMAGES_DIR, target_folder)
-        ensure_dir(local_folder)
-        local_path = os.path.join(local_folder, f"{new_num}.webp")
-        
-        if not convert_to_webp(temp_path, local_path):
-            os.remove(temp_path)
-            folder_counts[target_folder] -= 1
+        prefix = f"{STAGING_DIR}/{shard['name']}/{file_hash}"
+        shard["files"][f"{prefix}.webp"] = result["webp"]
+        for suffix, data in result["extras"].items():
+            shard["files"][f"{prefix}{suffix}"] = data
+        shard["bytes"] += len(result["webp"])
+        shard["images"] += 1
+        shard["hashes"].add(file_hash)
+        shard["phash"].add(info["phash"], file_hash)
+        shard["manifest"]["records"].append({"t": "image", **record, "info": info,
+                                             "size": len(result["webp"])})
+        record_encode(run_stats, result)
+        new_count += 1
+    
+    print(f"✅ [{page_id}] 暂存 {new_count} 张")
+    return "success"
+
+
+def commit_shard(shard: dict) -> bool:
+    """暂存文件与清单一起提交，清单中的 done_through 之前的页面才算完成"""
+    manifest = shard["manifest"]
+    files = dict(shard["files"])
+    files[f"{STAGING_DIR}/{shard['name']}.json"] = json.dumps(
+        manifest, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    images = shard["images"]
+    # 暂存目录和清单只属于本分片，分支被其他分片推进时可以安全重试
+    if not github_commit_files(files, f"Stage {images} images for shard {shard['name']}, "
+                                      f"through {manifest['done_through']}", retry_on_conflict=True):
+        return False
+    print(f"📤 [{shard['name']}] 已暂存 {images} 张, 进度 → {manifest['done_through']}")
+    shard["files"].clear()
+    shard["bytes"] = shard["images"] = 0
+    return True
+
+
+def crawl_shard(start_id: int, end_id: int, name: str):
+    """
+    分片模式：只爬取 [start_id, end_id]，不编号、不改动注册表、count.json 和 progress.json
+    新图片以 SHA-256 命名上传到 STAGING_DIR/<name>/，处理记录写入 STAGING_DIR/<name>.json，
+    多个分片可同时运行，最后由 merge 统一去重、编号
+    重新运行同一分片会从清单的 done_through 之后继续
+    """
+    print(f"🚀 分片 {name}: {start_id}..{end_id}\n")
+    if not GITHUB_TOKEN or not TARGET_REPO:
+        print("❌ 缺少 GH_TOKEN 或 TARGET_REPO")
+        return
+    
+    library = Library(github)
+    try:
+        library.load()
+        manifest = get_remote_json(f"{STAGING_DIR}/{name}.json", {})
+    except GitHubError as e:
+        print(f"❌ 获取远程数据失败: {e}")
+        return
+    
+    if manifest.get("start") != start_id or manifest.get("end") != end_id:
+        manifest = {"name": name, "start": start_id, "end": end_id,
+                    "done_through": start_id - 1, "records": []}
+    shard = {"name": name, "manifest": manifest, "files": {}, "bytes": 0, "images": 0,
+             "hashes": set(), "phash": MultiIndexHash()}
+    for r in manifest["records"]:
+        if r["t"] == "image":
+            shard["hashes"].add(r["hash"])
+            shard["phash"].add(r["info"]["phash"], r["hash"])
+    
+    current_id = manifest["done_through"] + 1
+    if current_id > end_id:
+        print("✅ 分片已完成")
+        return
+    
+    page_cache = PageCache(PAGE_CACHE_PATH)
+    page_cache.load()
+    session_cache = SessionCache(SESSION_CACHE_PATH)
+    prepare_session(session_cache)
+    
+    cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS,
+                                   mp_context=multiprocessing.get_context("spawn"))
+    pool = ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY)
+    pending = {}
+    run_stats = new_run_stats()
+    next_submit_id = current_id
+    failed = False
+    
+    try:
+        while current_id <= end_id:
+            while len(pending) < PAGE_CONCURRENCY and next_submit_id <= end_id:
+                pending[next_submit_id] = pool.submit(fetch_page, next_submit_id, library,
+                                                      page_cache, cpu_pool)
+                next_submit_id += 1
+            
+            if process_shard_page(current_id, pending.pop(current_id).result(), library,
+                                  shard, run_stats) != "success":
+                print(f"\n❌ [{current_id}] 处理出错，停止")
+                break
+            manifest["done_through"] = current_id
+            current_id += 1
+            
+            if shard["images"] >= UPLOAD_BATCH_FILES or shard["bytes"] >= UPLOAD_BATCH_BYTES:
+                if not commit_shard(shard):
+                    failed = True
+                    break
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        cpu_pool.shutdown(wait=True, cancel_futures=True)
+        if not failed:
+            commit_shard(shard)
+        page_cache.save()
+        session_cache.save()
+    
+    print_run_stats(run_stats)
+    metrics.print_summary()
+    metrics.save("shard")
+    print(f"\n🏁 分片 {name} 处理到 {manifest['done_through']}/{end_id}")
+
+
+def merge_shards():
+    """
+    合并已完成的分片：按页面ID顺序统一去重（SHA-256 与感知哈希）和编号，
+    暂存文件按 blob 移动到 vd/vl/hd/hl，索引、count.json、progress.json 一次提交
+    进度只推进到与当前进度连续衔接的已完成分片的末尾；未完成的分片留待下次合并
+    """
+    print("=" * 60)
+    print("🧩 合并分片")
+    print("=" * 60)
+    
+    library = Library(github)
+    try:
+        library.load()
+        head = github.head()
+        shards = [get_remote_json(f"{STAGING_DIR}/{name}")
+                  for name in github.list_tree(STAGING_DIR, head) if name.endswith(".json")]
+    except GitHubError as e:
+        print(f"❌ 获取远程数据失败: {e}")
+        return
+    
+    complete = sorted((m for m in shards if m["done_through"] >= m["end"]), key=lambda m: m["start"])
+    for m in shards:
+        if m["done_through"] < m["end"]:
+            print(f"⏳ 分片 {m['name']} 未完成 ({m['done_through']}/{m['end']})，跳过")
+    
+    try:
+        listings = {m["name"]: github.list_tree(f"{STAGING_DIR}/{m['name']}", head) for m in complete}
+    except GitHubError as e:
+        print(f"❌ 读取暂存文件失败: {e}")
+        return
+    
+    # 清单中的图片必须都有暂存文件，否则整个分片不合并（不推进进度、不删除暂存），重新运行该分片可补齐
+    for m in list(complete):
+        missing = [r["hash"] for r in m["records"] if r["t"] == "image"
+                   and any(f"{r['hash']}{suffix}" not in listings[m["name"]]
+                           for suffix in [".webp"] + r["info"].get("extras", []))]
+        if missing:
+            print(f"❌ 分片 {m['name']} 缺少 {len(missing)} 张图片的暂存文件（如 {missing[0][:12]}），不合并该分片")
+            complete.remove(m)
+    if not complete:
+        print("📭 没有可合并的分片")
+        return
+    
+    last_id = library.progress.get("last_id", START_ID - 1)
+    for m in complete:
+        if m["start"] > last_id + 1:
+            break
+        last_id = max(last_id, m["end"])
+    
+    records = sorted(((r["page"], m["start"], i, m["name"], r)
+                      for m in complete for i, r in enumerate(m["records"])), key=lambda x: x[:3])
+    files = {}
+    added = duplicates = 0
+    aliases = []
+    for _, _, _, name, r in records:
+        keys = [bytes.fromhex(k) for k in r["keys"]]
+        if r["t"] == "alias":
+            aliases.append((r, keys))
             continue
-        os.remove(temp_path)
         
-        # 添加到上传队列
-        remote_path = f"{IMAGES_DIR}/{target_folder}/{new_num}.webp"
-        upload_queue.append({
-            "local_path": local_path,
-            "remote_path": remote_path,
-            "hash": file_hash
-        })
+        file_hash = r["hash"]
+        target = file_hash if file_hash in library.registry else None
+        if target is None and PHASH_THRESHOLD >= 0:
+            match = library.phash_lookup.find(r["info"]["phash"], PHASH_THRESHOLD)
+            target = match[1] if match else None
+        if target:
+            register_alias(library, file_hash, keys, target)
+            duplicates += 1
+            continue
         
-        hash_registry[file_hash] = f"{target_folder}/{new_num}.webp"
-        new_count += 1
-        print(f"  💾 {local_path}")
+        suffixes = [".webp"] + r["info"].get("extras", [])
+        folder, num = assign_image(library, file_hash, keys, r["info"], r["size"])
+        for suffix in suffixes:
+            files[f"{IMAGES_DIR}/{folder}/{num}{suffix}"] = listings[name][f"{file_hash}{suffix}"]
+        added += 1
     
-    print(f"✅ 页面 {page_id} 完成，新增 {new_count} 张")
-    return "success"
+    # 别名在全部图片编号之后登记，目标可能来自其他分片
+    for r, keys in aliases:
+        if r["target"] in library.registry:
+            register_alias(library, r["hash"], keys, r["target"])
+    
+    for m in complete:
+        for file_name in listings[m["name"]]:
+            files[f"{STAGING_DIR}/{m['name']}/{file_name}"] = None
+        files[f"{STAGING_DIR}/{m['name']}.json"] = None
+    files.update(library.metadata_files(last_id))
+    
+    print(f"📦 {len(complete)} 个分片: 新增 {added} 张, 跨分片/已有重复 {duplicates} 张, 进度 → {last_id}")
+    if github_commit_files(files, f"Merge {len(complete)} shards: {added} images, progress to {last_id}"):
+        print("📤 合并已提交")
+    else:
+        print("❌ 提交失败，分片保留在暂存目录")
+    print("\n🏁 完成")
 
 
 # ============ 主函数 ============
@@ -392,99 +2951,197 @@ def main():
     
     # 获取远程数据
     print("📥 获取远程数据...")
-    progress = get_remote_json("progress.json", {"last_id": START_ID - 1})
-    hash_registry = get_remote_json(f"{IMAGES_DIR}/hash_registry.json", {})
-    folder_counts = get_remote_json(f"{IMAGES_DIR}/count.json", {})
-    
-    for f in FOLDERS:
-        if f not in folder_counts:
-            folder_counts[f] = 0
+    library = Library(github)
+    try:
+        library.load()
+    except GitHubError as e:
+        # 拿不到注册表时继续运行会导致去重失效，直接退出
+        print(f"❌ 获取远程数据失败: {e}")
+        return
     
-    current_id = progress.get("last_id", START_ID - 1) + 1
-    print(f"📍 从 ID {current_id} 开始\n")
+    print(f"📚 注册表: {library.registry.size} 条, URL 索引: {library.urls.size} 条, "
+          f"感知哈希: {library.phash_lookup.size} 条")
     
-    # 准备本地目录
-    if os.path.exists(LOCAL_DIR):
-        shutil.rmtree(LOCAL_DIR)
-    ensure_dir(LOCAL_DIR)
+    committed_id = library.progress.get("last_id", START_ID - 1)
     
+    # 恢复上次中断时已处理但未提交的页面
+    ensure_dir(SPOOL_DIR)
+    journal = CrawlJournal(JOURNAL_PATH)
     upload_queue = []
+    resumed_id = resume_from_journal(journal, library, upload_queue)
+    
+    # 清理不再被引用的本地文件
+    queued = {os.path.basename(item["local_path"]) for item in upload_queue}
+    for name in os.listdir(SPOOL_DIR):
+        if name not in queued:
+            os.remove(os.path.join(SPOOL_DIR, name))
+    
+    current_id = (resumed_id if resumed_id is not None else committed_id) + 1
+    print(f"📍 从 ID {current_id} 开始\n")
+    
     last_success_id = current_id - 1
     consecutive_404 = 0
+    consecutive_errors = 0
+    
+    page_cache = PageCache(PAGE_CACHE_PATH)
+    page_cache.load()
+    
+    session_cache = SessionCache(SESSION_CACHE_PATH)
+    prepare_session(session_cache)
+    
+    # 已知末尾时只爬取 [current_id, upper_id]，范围内的404视为已删除的空缺
+    upper_id = None
+    if DISCOVER_RANGE:
+        discovered = discover_upper_bound(current_id)
+        if discovered:
+            upper_id, source, probe_count = discovered
+            page_cache.mark_live(upper_id)
+            print(f"🔭 发现范围: {current_id}..{upper_id} "
+                  f"(来源: {source}, 请求 {probe_count} 次)\n")
+        else:
+            print(f"🔭 未能发现末尾ID，使用连续 {MAX_404_COUNT} 个404规则\n")
     
-    # ========== 阶段1: 本地处理 ==========
     print("=" * 60)
-    print("📥 阶段1: 本地下载和处理")
+    print(f"📥 抓取处理与上传并行 (并发页面: {PAGE_CONCURRENCY}, "
+          f"每批 ≤{UPLOAD_BATCH_FILES} 张/{UPLOAD_BATCH_BYTES // 1048576}MB)")
     print("=" * 60)
     
-    while True:
-        result = process_page_local(
-            current_id, 
-            hash_registry, 
-            folder_counts, 
-            upload_queue
-        )
-        
-        if result == "success":
-            last_success_id = current_id
-            consecutive_404 = 0
-            current_id += 1
+    # 抓取/下载在线程池中预取，分类/编码在进程池中并行，编号严格按ID顺序进行，
+    # 因此 last_success_id 始终连续，404 计数规则与串行时一致
+    # 已处理的图片在页面边界按批交给后台线程提交，进度只推进到已提交批次覆盖的ID
+    # 使用 spawn，避免在已有下载线程的进程中 fork
+    cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS,
+                                   mp_context=multiprocessing.get_context("spawn"))
+    pool = ThreadPoolExecutor(max_workers=PAGE_CONCURRENCY)
+    uploader = StreamingUploader(committed_id, journal)
+    pending = {}
+    run_stats = new_run_stats()
+    next_submit_id = current_id
+    
+    try:
+        retry_dead_letter(library, page_cache, cpu_pool, upload_queue, journal, run_stats)
+        
+        while True:
+            if upper_id is not None and current_id > upper_id:
+                print(f"\n⏹️ 到达末尾 ID {upper_id}")
+                break
             
-        elif result == "video":
-            # 视频页面，跳过继续
-            last_success_id = current_id  # 也算处理过了
-            consecutive_404 = 0
-            current_id += 1
+            while len(pending) < PAGE_CONCURRENCY and (upper_id is None or next_submit_id <= upper_id):
+                pending[next_submit_id] = pool.submit(fetch_page, next_submit_id, library,
+                                                      page_cache, cpu_pool)
+                next_submit_id += 1
             
-        elif result == "404":
-            consecutive_404 += 1
-            print(f"⚠️ 404 (连续: {consecutive_404}/{MAX_404_COUNT})")
+            metrics.gauge("queue.prefetched_pages", sum(f.done() for f in pending.values()))
+            metrics.gauge("queue.upload_files", len(upload_queue))
+            metrics.gauge("queue.upload_buffer_mb", uploader.queued_bytes / 1048576)
+            with metrics.timer("page.wait"):
+                fetched = pending.pop(current_id).result()
+            with metrics.timer("page.local"):
+                result = process_page_local(
+                    current_id,
+                    fetched,
+                    library,
+                    upload_queue,
+                    journal,
+                    run_stats
+                )
+            metrics.count(f"pages.{result}")
             
-            if consecutive_404 >= MAX_404_COUNT:
-                print(f"\n⏹️ 连续 {MAX_404_COUNT} 个404，到达末尾")
-                break
+            if result == "success":
+                last_success_id = current_id
+                consecutive_404 = 0
+                consecutive_errors = 0
+                current_id += 1
+                
+            elif result == "video":
+                # 视频页面，跳过继续
+                last_success_id = current_id  # 也算处理过了
+                consecutive_404 = 0
+                consecutive_errors = 0
+                current_id += 1
+                
+            elif result == "404" and upper_id is not None:
+                print(f"⚠️ 404（范围内的空缺，跳过）")
+                current_id += 1
+                
+            elif result == "404":
+                consecutive_404 += 1
+                print(f"⚠️ 404 (连续: {consecutive_404}/{MAX_404_COUNT})")
+                
+                if consecutive_404 >= MAX_404_COUNT:
+                    print(f"\n⏹️ 连续 {MAX_404_COUNT} 个404，到达末尾")
+                    break
+                
+                current_id += 1
+                
+            else:
+                # 出错（重试已用尽）：记入死信后越过；连续出错或预算用完多半是站点故障，停在出错的页面之前
+                consecutive_errors += 1
+                if retries.exhausted or consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+                    print(f"\n❌ 处理出错，停止（连续出错 {consecutive_errors} 次, "
+                          f"已重试 {retries.used}/{retries.budget} 次）")
+                    break
+                print(f"💀 [{current_id}] 重试用尽，记入死信后继续")
+                if library.dead_letter.add_page(current_id):
+                    journal.append({"t": "page", "id": current_id, "status": "dead"})
+                last_success_id = current_id
+                consecutive_404 = 0
+                current_id += 1
             
-            current_id += 1
+            if uploader.failed:
+                print(f"\n❌ 上传出错，停止")
+                break
             
-        else:
-            # 出错
-            print(f"\n❌ 处理出错，停止")
-            break
-    
-    # 清理临时目录
-    if os.path.exists(TEMP_DIR):
-        shutil.rmtree(TEMP_DIR)
-    
-    # ========== 阶段2: 批量上传 ==========
-    print("\n" + "=" * 60)
-    print("📤 阶段2: 批量上传到 GitHub")
-    print("=" * 60)
-    
-    if upload_queue:
-        print(f"\n📊 待上传: {len(upload_queue)} 个文件")
-        for f in FOLDERS:
-            count = sum(1 for item in upload_queue if f"/{f}/" in item["remote_path"])
-            if count > 0:
-                print(f"   {f}: {count} 张")
-        
-        batch_upload_to_github(
-            upload_queue, 
-            hash_registry, 
-            folder_counts, 
-            last_success_id
-        )
-    else:
-        print("\n📭 没有新图片")
-        # 仍然更新进度
-        progress["last_id"] = last_success_id
-        save_remote_json("progress.json", progress, f"Update progress to {last_success_id}")
+            if (len(upload_queue) >= UPLOAD_BATCH_FILES
+                    or sum(item["size"] for item in upload_queue) >= UPLOAD_BATCH_BYTES):
+                flush_uploads(uploader, library, upload_queue, last_success_id)
+    finally:
+        # 丢弃游标之后预取的页面
+        pool.shutdown(wait=True, cancel_futures=True)
+        cpu_pool.shutdown(wait=True, cancel_futures=True)
+        
+        # 最后一批（没有新图片时仍然更新进度和索引）
+        if not uploader.failed:
+            flush_uploads(uploader, library, upload_queue, last_success_id)
+        uploader.close()
+        journal.close(finished=not uploader.failed and uploader.committed_id == last_success_id)
+        page_cache.save()
+        session_cache.save()
     
-    # 清理
-    if os.path.exists(LOCAL_DIR):
-        shutil.rmtree(LOCAL_DIR)
+    print_run_stats(run_stats)
+    print(f"🗂️ 页面缓存: 短路 {page_cache.stats['short_circuit']}, "
+          f"未变化 {page_cache.stats['not_modified']}, 完整请求 {page_cache.stats['fetched']}")
+    print(f"📤 共提交 {uploader.batches} 批, {uploader.committed_images} 张图片, "
+          f"进度 → {uploader.committed_id}")
+    print(f"💀 死信: {len(library.dead_letter.pages)} 个页面, {len(library.dead_letter.images)} 张图片 "
+          f"(本次重试 {retries.used}/{retries.budget} 次)")
+    metrics.gauge("dead_letter.pages", len(library.dead_letter.pages))
+    metrics.gauge("dead_letter.images", len(library.dead_letter.images))
+    metrics.print_summary()
+    metrics.save("crawl")
     
     print("\n🏁 完成")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="图片爬虫")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("crawl", help="爬取新图片（默认）")
+    rebucket_parser = commands.add_parser("rebucket", help="按已存特征重新分桶")
+    rebucket_parser.add_argument("--backfill", action="store_true", help="先为没有特征的图片补算特征")
+    rebucket_parser.add_argument("--dry-run", action="store_true", help="只显示移动方案")
+    shard_parser = commands.add_parser("shard", help="分片爬取一段ID，结果暂存等待合并")
+    shard_parser.add_argument("--start", type=int, required=True)
+    shard_parser.add_argument("--end", type=int, required=True)
+    shard_parser.add_argument("--name", help="分片名（默认 <start>-<end>）")
+    commands.add_parser("merge", help="合并已完成的分片")
+    args = parser.parse_args()
+    
+    if args.command == "rebucket":
+        rebucket(args.backfill, args.dry_run)
+    elif args.command == "shard":
+        crawl_shard(args.start, args.end, args.name or f"{args.start}-{args.end}")
+    elif args.command == "merge":
+        merge_shards()
+    else:
+        main()
@@ -0,0 +1,648 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+scraper.py 的微基准
+
+    python scripts/scraper_bench.py links [页面.html 或目录 ...] [--fetch 342-360] [--repeat 20]
+
+    python scripts/scraper_bench.py classify 图片目录 [--batch 32]
+    python scripts/scraper_bench.py pipeline [--pages 40 --images 8 --size 1600x1200 ...] [--output 结果.json]
+
+links:    对比 BeautifulSoup 与 lxml XPath 提取画廊链接，校验结果一致，
+          报告每页解析耗时（中位数）和峰值内存（子进程 RSS 增量 / tracemalloc 峰值）
+classify: 对比全尺寸解码 + OpenCV LAB（原 analyze_image）与缩小解码 + 批量亮度 classify_images，
+          报告每张图片耗时、峰值 RSS、分类一致率和亮度偏差
+pipeline: 离线跑完整爬取流程：本地替身站点（合成存档页、视频页、404 空缺、重复图片）
+          + 内存中的假 GitHub（Contents / Git Data API），报告页面/s、图片/s、MB/s
+          和各阶段耗时/CPU，结果写入 JSON 便于跨版本对比
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import resource
+import statistics
+import tracemalloc
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import scraper
+
+FIXTURE_DIR = os.path.join(scraper.STATE_DIR, "fixtures")
+
+
+# ============ 页面样本 ============
+
+def fetch_fixtures(id_range: str) -> list:
+    """下载一段ID的存档页面保存为样本，跳过404"""
+    first, _, last = id_range.partition("-")
+    scraper.ensure_dir(FIXTURE_DIR)
+    paths = []
+    for page_id in range(int(first), int(last or first) + 1):
+        resp = scraper.polite_get(scraper.build_url(page_id), timeout=30)
+        if resp.status_code != 200:
+            print(f"⏭️ [{page_id}] HTTP {resp.status_code}，跳过")
+            continue
+        path = os.path.join(FIXTURE_DIR, f"{page_id}.html")
+        with open(path, "wb") as f:
+            f.write(resp.content)
+        paths.append(path)
+    print(f"💾 已保存 {len(paths)} 个样本到 {FIXTURE_DIR}")
+    return paths
+
+
+def collect_fixtures(args: list) -> list:
+    paths = []
+    for arg in args or [FIXTURE_DIR]:
+        if os.path.isdir(arg):
+            paths += sorted(os.path.join(arg, name) for name in os.listdir(arg) if name.endswith(".html"))
+        else:
+            paths.append(arg)
+    return paths
+
+
+# ============ 链接提取 ============
+
+def links_bs4(html: bytes) -> list:
+    """原实现：完整构建 BeautifulSoup 树"""
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(html.decode("utf-8", "replace"), "lxml")
+    images = []
+    for idx, link in enumerate(soup.find_all("a", {"data-fancybox": True}), 1):
+        href = link.get("href", "")
+        if href.startswith("http"):
+            images.append({"url": href, "index": idx})
+    return images
+
+
+PARSERS = {"bs4": links_bs4, "lxml": scraper.extract_image_links}
+
+
+def peak_rss_kb(reset: bool = False) -> int:
+    """进程 RSS 峰值（KB）；Linux 下可通过 clear_refs 重置峰值，只统计之后的部分"""
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure_memory(name: str, path: str) -> tuple:
+    """在独立子进程中解析一次，返回 (RSS 峰值增量KB, tracemalloc 峰值KB)"""
+    with open(path, "rb") as f:
+        html = f.read()
+    parse = PARSERS[name]
+    if name == "bs4":
+        import bs4  # noqa: F401  导入开销不计入解析
+    before = peak_rss_kb(reset=True)
+    tracemalloc.start()
+    parse(html)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    after = peak_rss_kb()
+    return after - before, traced_peak // 1024
+
+
+def bench_links(paths: list, repeat: int):
+    ctx = multiprocessing.get_context("spawn")
+    totals = {name: {"seconds": [], "rss": [], "traced": []} for name in PARSERS}
+
+    print(f"{'页面':<24}{'链接':>6}  " + "  ".join(
+        f"{name + ' ms':>10}{name + ' RSS':>10}{name + ' py':>9}" for name in PARSERS))
+
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for path in paths:
+            with open(path, "rb") as f:
+                html = f.read()
+            results = {name: parse(html) for name, parse in PARSERS.items()}
+            if results["bs4"] != results["lxml"]:
+                print(f"❌ {path}: 提取结果不一致")
+                print(f"   bs4:  {results['bs4']}")
+                print(f"   lxml: {results['lxml']}")
+                sys.exit(1)
+
+            row = f"{os.path.basename(path):<24}{len(results['lxml']):>6}  "
+            for name, parse in PARSERS.items():
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    parse(html)
+                    timings.append(time.perf_counter() - start)
+                seconds = statistics.median(timings)
+                rss, traced = pool.apply(measure_memory, (name, path))
+                totals[name]["seconds"].append(seconds)
+                totals[name]["rss"].append(rss)
+                totals[name]["traced"].append(traced)
+                row += f"{seconds * 1000:>10.2f}{rss:>8}KB{traced:>7}KB  "
+            print(row)
+
+    print("\n📊 每页平均:")
+    for name, stats in totals.items():
+        print(f"   {name:<5} {statistics.mean(stats['seconds']) * 1000:.2f} ms, "
+              f"RSS 峰值 +{statistics.mean(stats['rss']):.0f} KB, "
+              f"Python 分配峰值 {statistics.mean(stats['traced']):.0f} KB")
+    speedup = statistics.mean(totals["bs4"]["seconds"]) / statistics.mean(totals["lxml"]["seconds"])
+    print(f"⚡ lxml 提速 {speedup:.1f}x（{len(paths)} 个页面，结果一致）")
+
+
+# ============ 亮度分类 ============
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".gif")
+
+
+def classify_full(blobs: list) -> list:
+    """参照实现（原 analyze_image 的副本）：逐张全尺寸解码，缩放到 100x100 后取 LAB L 通道均值"""
+    results = []
+    for data in blobs:
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        h, w = img.shape[:2] if img is not None else (0, 0)
+        if w < 10 or h < 10:
+            results.append(None)
+            continue
+        lab = cv2.cvtColor(cv2.resize(img, (100, 100)), cv2.COLOR_BGR2LAB)
+        results.append(scraper.classify(w, h, lab[:, :, 0].mean()))
+    return results
+
+
+def classify_reduced(blobs: list, batch: int) -> list:
+    results = []
+    for i in range(0, len(blobs), batch):
+        results += scraper.classify_images(blobs[i:i + batch])
+    return results
+
+
+def run_classifier(name: str, paths: list, batch: int) -> tuple:
+    """在独立子进程中跑完整个语料，返回 (结果, 总耗时, RSS 峰值增量KB)"""
+    blobs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            blobs.append(f.read())
+    before = peak_rss_kb(reset=True)
+    start = time.perf_counter()
+    results = classify_full(blobs) if name == "full" else classify_reduced(blobs, batch)
+    seconds = time.perf_counter() - start
+    return results, seconds, peak_rss_kb() - before
+
+
+def bench_classify(paths: list, batch: int):
+    ctx = multiprocessing.get_context("spawn")
+    runs = {}
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for name in ["full", "reduced"]:
+            runs[name] = pool.apply(run_classifier, (name, paths, batch))
+
+    for name, (results, seconds, rss) in runs.items():
+        print(f"   {name:<8} {seconds / len(paths) * 1000:.2f} ms/张, RSS 峰值 +{rss} KB")
+
+    full, reduced = runs["full"][0], runs["reduced"][0]
+    same = diffs = 0
+    for path, a, b in zip(paths, full, reduced):
+        if a is None or b is None:
+            if (a is None) != (b is None):
+                print(f"⚠️ {os.path.basename(path)}: 一方无法分类 ({a}, {b})")
+            continue
+        diffs = max(diffs, abs(a["brightness"] - b["brightness"]))
+        if (a["folder"], a["width"], a["height"]) == (b["folder"], b["width"], b["height"]):
+            same += 1
+        else:
+            print(f"⚠️ {os.path.basename(path)}: {a['folder']} {a['width']}x{a['height']} L={a['brightness']:.1f}"
+                  f" → {b['folder']} {b['width']}x{b['height']} L={b['brightness']:.1f}")
+    print(f"📊 分类一致 {same}/{len(paths)}，最大亮度偏差 {diffs:.2f}（阈值 {scraper.BRIGHTNESS_THRESHOLD}）")
+    print(f"⚡ 缩小解码提速 {runs['full'][1] / runs['reduced'][1]:.1f}x")
+
+
+# ============ 本地替身站点 ============
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def log_message(self, *args):
+        pass
+    
+    def send(self, code: int, body: bytes, content_type: str = "application/json", headers: dict = None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(handler: type) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StandInSite:
+    """
+    合成的图片站：/index.php/archives/<id>.html 为存档页，/img/<n>.jpg 为图片，
+    /index.php/feed/ 列出最新的存档ID；每隔 video_every 页一个视频页，每隔 gap_every 个ID一个404
+    dup_ratio 比例的图片链接指向新URL下的已有图片内容（精确重复）
+    """
+    
+    def __init__(self, start_id: int, pages: int, images: int, size: tuple, video_every: int,
+                 gap_every: int, dup_ratio: float, latency: float):
+        self.latency = latency
+        self.pages = {}
+        self.images = {}
+        self.bytes_served = 0
+        self._lock = threading.Lock()
+        rng = np.random.default_rng(0)
+        
+        page_id = start_id
+        unique = 0
+        for n in range(pages):
+            if gap_every and n and n % gap_every == 0:
+                page_id += 1
+            if video_every and n % video_every == video_every - 1:
+                self.pages[page_id] = None
+            else:
+                links = []
+                for _ in range(images):
+                    url_id = len(self.images)
+                    if unique and rng.random() < dup_ratio:
+                        self.images[url_id] = self.images[int(rng.integers(0, url_id))]
+                    else:
+                        self.images[url_id] = self._make_image(unique, size)
+                        unique += 1
+                    links.append(url_id)
+                self.pages[page_id] = links
+            page_id += 1
+        self.unique_images = unique
+        self.last_id = page_id - 1
+    
+    @staticmethod
+    def _make_image(seed: int, size: tuple) -> bytes:
+        """低分辨率随机色块放大后编码为 JPEG，保证每张图的感知哈希互不相近"""
+        rng = np.random.default_rng(seed + 1)
+        w, h = size if seed % 3 else (size[1], size[0])
+        base = rng.random(3) * 255
+        small = np.clip(base + rng.normal(0, 60, (max(2, h // 64), max(2, w // 64), 3)), 0, 255)
+        img = cv2.resize(small.astype(np.uint8), (w, h), interpolation=cv2.INTER_CUBIC)
+        return cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+    
+    def start(self) -> str:
+        site = self
+        
+        class Handler(QuietHandler):
+            def do_GET(self):
+                if site.latency:
+                    time.sleep(site.latency)
+                path = self.path.split("?")[0]
+                if path == "/index.php/feed/":
+                    body = "".join(f'<link>/index.php/archives/{i}.html</link>' for i in site.pages)
+                    return self.send(200, body.encode("utf-8"), "application/rss+xml")
+                m = re.fullmatch(r"/index.php/archives/(\d+)\.html", path)
+                if m and int(m.group(1)) in site.pages:
+                    links = site.pages[int(m.group(1))]
+                    if links is None:
+                        body = '<html><body><video src="/v.mp4"></video></body></html>'
+                    else:
+                        host = f"http://127.0.0.1:{site.port}"
+                        body = "<html><body>" + "".join(
+                            f'<a data-fancybox="gallery" href="{host}/img/{n}.jpg"><img src="t.jpg"></a>'
+                            for n in links) + "</body></html>"
+                    return self.send(200, body.encode("utf-8"), "text/html; charset=utf-8")
+                m = re.fullmatch(r"/img/(\d+)\.jpg", path)
+                if m and int(m.group(1)) in site.images:
+                    data = site.images[int(m.group(1))]
+                    with site._lock:
+                        site.bytes_served += len(data)
+                    return self.send(200, data, "image/jpeg")
+                self.send(404, b"not found", "text/plain")
+        
+        self.server = serve(Handler)
+        self.port = self.server.server_address[1]
+        return f"http://127.0.0.1:{self.port}"
+
+
+class FakeGitHub:
+    """
+    内存中的目标仓库，实现 scraper 用到的 Contents API（读取/目录列表）
+    和 Git Data API（blob、tree、commit、ref），行为与 GitHub 一致的限制：
+    分支引用只允许快进更新，目录列表最多 CONTENTS_LIST_MAX 条，删除不存在的路径返回 422
+    仓库内部是扁平的 {path: sha}，读取 tree 时子目录按内容另存为扁平 tree，sha 与 git 一样只取决于内容
+    """
+    
+    CONTENTS_LIST_MAX = 1000
+    
+    def __init__(self, branch: str = "main"):
+        self.branch = branch
+        self.blobs = {}
+        self.trees = {}
+        self.commits = {}
+        self.requests = 0
+        self._lock = threading.Lock()
+        self.head = self._commit(self._tree({}), [], "init")
+    
+    def _tree(self, entries: dict) -> str:
+        sha = hashlib.sha1(json.dumps(sorted(entries.items())).encode("utf-8")).hexdigest()
+        self.trees[sha] = dict(entries)
+        return sha
+    
+    def _commit(self, tree: str, parents: list, message: str) -> str:
+        sha = hashlib.sha1(f"{tree}{parents}{message}{len(self.commits)}".encode("utf-8")).hexdigest()
+        self.commits[sha] = {"tree": tree, "parents": parents, "message": message}
+        return sha
+    
+    def _blob(self, content: bytes) -> str:
+        sha = hashlib.sha1(content).hexdigest()
+        self.blobs[sha] = content
+        return sha
+    
+    def files(self) -> dict:
+        return self.trees[self.commits[self.head]["tree"]]
+    
+    def _ancestors(self, sha: str) -> set:
+        seen, stack = set(), [sha]
+        while stack:
+            sha = stack.pop()
+            seen.add(sha)
+            stack += self.commits[sha]["parents"]
+        return seen
+    
+    def route(self, method: str, path: str, body: dict) -> tuple:
+        """返回 (状态码, JSON 对象)"""
+        files = self.files()
+        if path.startswith("contents/"):
+            path = path[len("contents/"):]
+            if path in files:
+                sha = files[path]
+                return 200, {"sha": sha, "encoding": "base64",
+                             "content": base64.b64encode(self.blobs[sha]).decode("utf-8")}
+            prefix = path + "/"
+            children = {p[len(prefix):] for p in files if p.startswith(prefix)}
+            if not children:
+                return 404, {"message": "Not Found"}
+            listing = []
+            for name in sorted({name.split("/")[0] for name in children}):
+                if name not in children:
+                    listing.append({"name": name, "type": "dir", "sha": "", "size": 0})
+                else:
+                    sha = files[prefix + name]
+                    listing.append({"name": name, "type": "file", "sha": sha, "size": len(self.blobs[sha])})
+            # 与 GitHub 一致：超出上限的条目被静默截掉
+            return 200, listing[:self.CONTENTS_LIST_MAX]
+        
+        if path == "git/blobs":
+            return 201, {"sha": self._blob(base64.b64decode(body["content"]))}
+        if path.startswith("git/blobs/"):
+            sha = path.split("/")[-1]
+            return 200, {"sha": sha, "encoding": "base64",
+                         "content": base64.b64encode(self.blobs[sha]).decode("utf-8")}
+        if path in (f"git/ref/heads/{self.branch}", f"git/refs/heads/{self.branch}"):
+            if method == "PATCH":
+                if body["sha"] not in self.commits or self.head not in self._ancestors(body["sha"]):
+                    return 422, {"message": "Update is not a fast forward"}
+                self.head = body["sha"]
+            return 200, {"object": {"sha": self.head}}
+        if path.startswith("git/commits/"):
+            return 200, {"tree": {"sha": self.commits[path.split("/")[-1]]["tree"]}}
+        if path == "git/commits":
+            return 201, {"sha": self._commit(body["tree"], body["parents"], body["message"])}
+        if path.startswith("git/trees/") and method == "GET":
+            sha = path[len("git/trees/"):]
+            if sha not in self.trees:
+                return 404, {"message": "Not Found"}
+            blobs, subtrees = {}, {}
+            for name, blob in self.trees[sha].items():
+                part, _, rest = name.partition("/")
+                if rest:
+                    subtrees.setdefault(part, {})[rest] = blob
+                else:
+                    blobs[part] = blob
+            tree = [{"path": name, "type": "blob", "sha": blob} for name, blob in blobs.items()]
+            tree += [{"path": name, "type": "tree", "sha": self._tree(entries)} for name, entries in subtrees.items()]
+            return 200, {"sha": sha, "tree": tree, "truncated": False}
+        if path == "git/trees":
+            entries = dict(self.trees[body["base_tree"]]) if body.get("base_tree") else {}
+            for entry in body["tree"]:
+                if entry["sha"] is None:
+                    if entry["path"] not in entries:
+                        return 422, {"message": f"GitTree: path '{entry['path']}' does not exist"}
+                    del entries[entry["path"]]
+                else:
+                    entries[entry["path"]] = entry["sha"]
+            return 201, {"sha": self._tree(entries)}
+        return 404, {"message": "Not Found"}
+    
+    def start(self) -> str:
+        gh = self
+        
+        class Handler(QuietHandler):
+            def handle_method(self, method: str):
+                m = re.fullmatch(r"/repos/[^/]+/[^/]+/([^?]*)(\?.*)?", self.path)
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"null")
+                with gh._lock:
+                    gh.requests += 1
+                    code, data = gh.route(method, m.group(1), body) if m else (404, {})
+                # 文件读取带 ETag，scraper 的条件请求命中时返回 304
+                if method == "GET" and code == 200 and isinstance(data, dict) and "content" in data:
+                    etag = f'"{data["sha"]}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        return self.send(304, b"", headers={"ETag": etag})
+                    return self.send(code, json.dumps(data).encode("utf-8"), headers={"ETag": etag})
+                self.send(code, json.dumps(data).encode("utf-8"))
+            
+            def do_GET(self):
+                self.handle_method("GET")
+            
+            def do_POST(self):
+                self.handle_method("POST")
+            
+            def do_PATCH(self):
+                self.handle_method("PATCH")
+        
+        self.server = serve(Handler)
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+
+# ============ 完整流程 ============
+
+class StageTimer:
+    """包装 scraper 中各阶段的函数，累计墙钟时间和调用线程的 CPU 时间"""
+    
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+    
+    def wrap(self, stage: str, fn):
+        def timed(*args, **kwargs):
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    totals = self.stages.setdefault(stage, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+                    totals["calls"] += 1
+                    totals["wall_s"] += time.perf_counter() - wall
+                    totals["cpu_s"] += time.thread_time() - cpu
+        return timed
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(args) -> dict:
+    width, height = (int(v) for v in args.size.split("x"))
+    print(f"🏗️ 生成替身站点: {args.pages} 页 × {args.images} 张 ({args.size})...")
+    site = StandInSite(scraper.START_ID, args.pages, args.images, (width, height), args.video_every,
+                       args.gap_every, args.dup_ratio, args.latency / 1000)
+    gh = FakeGitHub(scraper.TARGET_BRANCH)
+    
+    # 指向替身服务，状态目录放到临时目录，不影响真实运行
+    state_dir = tempfile.mkdtemp(prefix="scraper-bench-")
+    scraper.SITE_URL = site.start()
+    scraper.GITHUB_API = gh.start()
+    scraper.GITHUB_TOKEN, scraper.TARGET_REPO = "bench", "bench/library"
+    scraper.github = scraper.GitHubClient("bench", "bench/library", scraper.TARGET_BRANCH)
+    scraper.SPOOL_DIR = os.path.join(state_dir, "spool")
+    scraper.JOURNAL_PATH = os.path.join(state_dir, "journal.jsonl")
+    scraper.PAGE_CACHE_PATH = os.path.join(state_dir, "page_cache.json")
+    scraper.SESSION_CACHE_PATH = os.path.join(state_dir, "session.bin")
+    scraper.METRICS_PATH = os.path.join(state_dir, "metrics.json")
+    
+    timer = StageTimer()
+    for stage, name in [("fetch", "scrape_images"), ("download", "download_image"),
+                        ("local", "process_page_local"), ("commit", "batch_upload_to_github")]:
+        setattr(scraper, name, timer.wrap(stage, getattr(scraper, name)))
+    captured = {}
+    print_run_stats = scraper.print_run_stats
+    
+    def capture_run_stats(run_stats):
+        captured.update(run_stats)
+        print_run_stats(run_stats)
+    
+    scraper.print_run_stats = capture_run_stats
+    
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_before = time.process_time()
+    start = time.perf_counter()
+    scraper.main()
+    wall = time.perf_counter() - start
+    cpu_main = time.process_time() - cpu_before
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_children = (children.ru_utime + children.ru_stime
+                    - children_before.ru_utime - children_before.ru_stime)
+    
+    files = gh.files()
+    stored = sum(1 for path in files if re.fullmatch(rf"{scraper.IMAGES_DIR}/(vd|vl|hd|hl)/\d+\.webp", path))
+    workers = captured.get("workers", {})
+    stages = dict(timer.stages)
+    stages["process"] = {
+        "calls": sum(w["count"] for w in workers.values()),
+        "wall_s": sum(w["seconds"] for w in workers.values()),
+        "cpu_s": cpu_children
+    }
+    
+    result = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "config": {
+            "pages": args.pages, "images_per_page": args.images, "size": args.size,
+            "video_every": args.video_every, "gap_every": args.gap_every, "dup_ratio": args.dup_ratio,
+            "latency_ms": args.latency, "page_concurrency": scraper.PAGE_CONCURRENCY,
+            "image_concurrency": scraper.IMAGE_CONCURRENCY, "cpu_workers": scraper.CPU_WORKERS
+        },
+        "wall_s": wall,
+        "pages_per_s": len(site.pages) / wall,
+        "images_per_s": stored / wall,
+        "mb_per_s": site.bytes_served / 1048576 / wall,
+        "downloaded_mb": site.bytes_served / 1048576,
+        "stored_images": stored,
+        "expected_images": site.unique_images,
+        "cpu_s": {"main": cpu_main, "workers": cpu_children},
+        "stages": stages,
+        "metrics": scraper.metrics.snapshot("bench"),
+        "github_requests": gh.requests,
+        "commits": len(gh.commits) - 1
+    }
+    
+    print("\n" + "=" * 60)
+    print(f"📊 {len(site.pages)} 页 / {stored} 张 ({site.bytes_served / 1048576:.1f}MB) 用时 {wall:.1f}s")
+    print(f"   {result['pages_per_s']:.1f} 页/s, {result['images_per_s']:.1f} 张/s, {result['mb_per_s']:.1f} MB/s")
+    print(f"   CPU: 主进程 {cpu_main:.1f}s, 处理进程 {cpu_children:.1f}s")
+    for stage, totals in stages.items():
+        print(f"   {stage:<9} {totals['calls']:>5} 次, 墙钟 {totals['wall_s']:.1f}s, CPU {totals['cpu_s']:.1f}s")
+    if stored != site.unique_images:
+        print(f"⚠️ 保存 {stored} 张，与替身站点中的唯一图片数 {site.unique_images} 不一致")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="scraper.py 微基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    links = sub.add_parser("links", help="链接提取: BeautifulSoup vs lxml XPath")
+    links.add_argument("fixtures", nargs="*", help=f"HTML 文件或目录（默认 {FIXTURE_DIR}）")
+    links.add_argument("--fetch", help="先下载一段ID作为样本，如 342-360")
+    links.add_argument("--repeat", type=int, default=20)
+
+    classify = sub.add_parser("classify", help="亮度分类: 全尺寸解码 vs 缩小解码批处理")
+    classify.add_argument("corpus", help="本地图片目录")
+    classify.add_argument("--batch", type=int, default=32)
+
+    pipeline = sub.add_parser("pipeline", help="离线完整流程: 替身站点 + 假 GitHub")
+    pipeline.add_argument("--pages", type=int, default=40)
+    pipeline.add_argument("--images", type=int, default=8, help="每页图片数")
+    pipeline.add_argument("--size", default="1600x1200", help="图片尺寸 WxH")
+    pipeline.add_argument("--video-every", type=int, default=10, help="每隔多少页一个视频页（0 为不生成）")
+    pipeline.add_argument("--gap-every", type=int, default=15, help="每隔多少页一个404空缺（0 为不生成）")
+    pipeline.add_argument("--dup-ratio", type=float, default=0.1, help="重复图片比例")
+    pipeline.add_argument("--latency", type=float, default=0, help="站点每个请求的附加延迟（毫秒）")
+    pipeline.add_argument("--output", help="结果 JSON 路径（默认写到系统临时目录 scraper-bench/pipeline-<时间>.json）")
+
+    args = parser.parse_args()
+
+    if args.command == "links":
+        paths = fetch_fixtures(args.fetch) if args.fetch else collect_fixtures(args.fixtures)
+        if not paths:
+            print("❌ 没有页面样本，使用 --fetch 下载或传入 HTML 文件")
+            sys.exit(1)
+        bench_links(paths, args.repeat)
+    elif args.command == "classify":
+        paths = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus)
+                       if name.lower().endswith(IMAGE_EXTS))
+        if not paths:
+            print(f"❌ {args.corpus} 中没有图片")
+            sys.exit(1)
+        print(f"🖼️ {len(paths)} 张图片，批大小 {args.batch}")
+        bench_classify(paths, args.batch)
+    elif args.command == "pipeline":
+        result = bench_pipeline(args)
+        output = args.output or os.path.join(tempfile.gettempdir(), "scraper-bench",
+                                             f"pipeline-{time.strftime('%Y%m%d-%H%M%S')}.json")
+        scraper.ensure_dir(os.path.dirname(output) or ".")
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 结果已写入 {output}")
+
+
+if __name__ == '__main__':
+    main()